@@ -0,0 +1,30 @@
+"""图片编码（在进程池中执行）
+
+此模块只依赖 numpy 和 PIL，进程池使用 spawn 启动时不会重新导入 main.py 中的模型和服务。
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+# output_format -> (PIL 格式, 文件扩展名)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "png"),
+    "jpeg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+    "webp_lossless": ("WEBP", "webp"),
+}
+
+def encode_array(image, output_format="png", compress_level=6, quality=90):
+    """把 HWC uint8 数组（或 PIL 图片）编码为指定格式，返回 (bytes, 扩展名)"""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    pil_format, ext = OUTPUT_FORMATS[output_format]
+    buffered = io.BytesIO()
+    if output_format == "png":
+        image.save(buffered, format=pil_format, compress_level=min(max(compress_level, 0), 9))
+    elif output_format == "webp_lossless":
+        image.save(buffered, format=pil_format, lossless=True, quality=quality)
+    else:
+        image.save(buffered, format=pil_format, quality=min(max(quality, 1), 100))
+    return buffered.getvalue(), ext
@@ -1,8 +1,20 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+import os
+import sys
+
+if __name__ == "__main__":
+    # 直接运行本文件时改由 uvicorn 以模块 main 导入：编码进程池以 spawn 启动，
+    # 若本文件是 __main__，每个子进程都会把它当作 __mp_main__ 整个重新执行（导入 torch、建库、建 app）
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+        "--host", "0.0.0.0", "--port", "8000",
+    ])
+
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Header
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from typing import Optional, List, Any
+from fastapi.responses import StreamingResponse, Response, JSONResponse, FileResponse
+from pydantic import BaseModel, field_validator
+from typing import Optional, List, Any, Literal, Annotated
 try:
     from diffusers import ZImagePipeline, OvisImagePipeline, Flux2Pipeline
 except ImportError:
@@ -12,15 +24,30 @@ except ImportError:
     Flux2Pipeline = None
 
 import torch
+import numpy as np
 import io
 import base64
 from fastapi.middleware.cors import CORSMiddleware
-import os
 from PIL import Image
 import json
 from datetime import datetime
 import time
 import asyncio
+import threading
+import concurrent.futures
+import sqlite3
+import copy
+import hashlib
+import uuid
+import contextvars
+import math
+import random
+import shutil
+import multiprocessing
+from collections import OrderedDict, deque
+from image_encoding import encode_array, OUTPUT_FORMATS
+from metrics import Registry
+from profiling import RequestProfile, BatchProfiler, list_profiles
 
 # Import MCP
 from mcp.server.fastmcp import FastMCP
@@ -44,83 +71,288 @@ mcp = FastMCP(
 )
 
 CONFIG_FILE = "../config.json"
-HISTORY_FILE = "generation_history.json"
+HISTORY_FILE = "generation_history.json"  # 旧版历史文件，仅用于一次性迁移
+HISTORY_DB = "generation_history.db"
 PRESETS_FILE = "presets.json"
 MODELS_CONFIG_FILE = "models_config.json"
+CONFIG_CHECK_INTERVAL = 1.0  # 两次检查文件 mtime 的最小间隔（秒）
 
-def load_config():
-    if os.path.exists(CONFIG_FILE):
+class JsonFileCache:
+    """内存中的 JSON 配置文件缓存
+
+    只有文件 mtime 变化（最多每 CONFIG_CHECK_INTERVAL 秒检查一次）或通过 save() 写入时才重新解析，
+    热路径上不再有磁盘读取和 JSON 解析。version 在每次内容变化时递增，供派生索引判断是否失效。
+    """
+    def __init__(self, path, default, indent=2):
+        self.path = path
+        self.default = default
+        self.indent = indent
+        self.version = 0
+        self._lock = threading.Lock()
+        self._data = None
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def _file_mtime(self):
         try:
-            with open(CONFIG_FILE, "r") as f:
-                return json.load(f)
-        except:
-            pass
-    return {"cache_dir": None, "model_id": "Tongyi-MAI/Z-Image-Turbo"}
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self):
+        """返回缓存的数据（只读，修改前请使用 load() 取得副本）"""
+        now = time.time()
+        with self._lock:
+            if self._data is not None and now - self._checked_at < CONFIG_CHECK_INTERVAL:
+                return self._data
+            self._checked_at = now
+            mtime = self._file_mtime()
+            if self._data is not None and mtime == self._mtime:
+                return self._data
+            data = copy.deepcopy(self.default)
+            if mtime is not None:
+                try:
+                    with open(self.path, "r") as f:
+                        data = json.load(f)
+                except:
+                    pass
+            self._data, self._mtime = data, mtime
+            self.version += 1
+            return self._data
+
+    def load(self):
+        return copy.deepcopy(self.get())
+
+    def save(self, data):
+        with self._lock:
+            with open(self.path, "w") as f:
+                json.dump(data, f, indent=self.indent)
+            self._data = copy.deepcopy(data)
+            self._mtime = self._file_mtime()
+            self._checked_at = time.time()
+            self.version += 1
+
+config_cache = JsonFileCache(CONFIG_FILE, {"cache_dir": None, "model_id": "Tongyi-MAI/Z-Image-Turbo"}, indent=4)
+presets_cache = JsonFileCache(PRESETS_FILE, {})
+models_config_cache = JsonFileCache(MODELS_CONFIG_FILE, {"models": [], "current_model": "Tongyi-MAI/Z-Image-Turbo"})
+
+def load_config():
+    return config_cache.load()
 
 def save_config(config):
     try:
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(config, f, indent=4)
+        config_cache.save(config)
     except Exception as e:
         print(f"Error saving config: {e}")
 
-def load_history():
-    if os.path.exists(HISTORY_FILE):
+class HistoryStore:
+    """基于 SQLite 的追加式生成历史
+
+    每条记录单独 INSERT，写入开销与历史总量无关；连接由锁保护，多个生成线程可并发写入。
+    查询按自增 id 倒序做游标分页。
+    """
+    def __init__(self, path, legacy_file=None):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, model_id TEXT, "
+            "width INTEGER, height INTEGER, entry TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_model ON history(model_id)")
+        if legacy_file and os.path.exists(legacy_file):
+            self._migrate(legacy_file)
+
+    def _migrate(self, legacy_file):
+        """从旧版 generation_history.json 一次性导入，完成后重命名旧文件"""
         try:
-            with open(HISTORY_FILE, "r") as f:
-                return json.load(f)
-        except:
-            pass
-    return []
+            with open(legacy_file, "r") as f:
+                entries = json.load(f)
+            with self._lock:
+                self._conn.execute("BEGIN")
+                for entry in entries:
+                    self._insert(entry)
+                self._conn.execute("COMMIT")
+            os.replace(legacy_file, legacy_file + ".migrated")
+            print(f"Migrated {len(entries)} history entries from {legacy_file}")
+        except Exception as e:
+            print(f"Error migrating history: {e}")
+
+    def _insert(self, entry):
+        params = entry.get("params", {})
+        self._conn.execute(
+            "INSERT INTO history (timestamp, model_id, width, height, entry) VALUES (?, ?, ?, ?, ?)",
+            (entry.get("timestamp", datetime.now().isoformat()), entry.get("model_id"),
+             params.get("width"), params.get("height"), json.dumps(entry, ensure_ascii=False)),
+        )
 
-def save_history(history):
-    try:
-        with open(HISTORY_FILE, "w") as f:
-            json.dump(history[-100:], f, indent=2)  # Keep last 100
-    except Exception as e:
-        print(f"Error saving history: {e}")
+    def append(self, entry):
+        try:
+            with self._lock:
+                self._insert(entry)
+        except Exception as e:
+            print(f"Error saving history: {e}")
+
+    def query(self, cursor=None, limit=50, since=None, until=None, model_id=None, width=None, height=None):
+        """返回 (按时间倒序的记录, 下一页游标)"""
+        clauses, args = [], []
+        for clause, value in (
+            ("id < ?", cursor),
+            ("timestamp >= ?", since),
+            ("timestamp <= ?", until),
+            ("model_id = ?", model_id),
+            ("width = ?", width),
+            ("height = ?", height),
+        ):
+            if value is not None:
+                clauses.append(clause)
+                args.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, entry FROM history {where} ORDER BY id DESC LIMIT ?", (*args, limit + 1)
+            ).fetchall()
+        items = [{"id": row[0], **json.loads(row[1])} for row in rows[:limit]]
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return items, next_cursor
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM history")
 
 def load_presets():
-    if os.path.exists(PRESETS_FILE):
-        try:
-            with open(PRESETS_FILE, "r") as f:
-                return json.load(f)
-        except:
-            pass
-    return {}
+    return presets_cache.load()
 
 def save_presets(presets):
     try:
-        with open(PRESETS_FILE, "w") as f:
-            json.dump(presets, f, indent=2)
+        presets_cache.save(presets)
     except Exception as e:
         print(f"Error saving presets: {e}")
 
 def load_models_config():
     """加载模型配置"""
-    if os.path.exists(MODELS_CONFIG_FILE):
-        try:
-            with open(MODELS_CONFIG_FILE, "r") as f:
-                return json.load(f)
-        except:
-            pass
-    return {"models": [], "current_model": "Tongyi-MAI/Z-Image-Turbo"}
+    return models_config_cache.load()
 
 def save_models_config(config):
     """保存模型配置"""
     try:
-        with open(MODELS_CONFIG_FILE, "w") as f:
-            json.dump(config, f, indent=2)
+        models_config_cache.save(config)
     except Exception as e:
         print(f"Error saving models config: {e}")
 
+_model_index = {"version": None, "models": {}}
+
 def get_model_info(model_id):
-    """获取模型信息"""
-    models_cfg = load_models_config()
-    for model in models_cfg.get("models", []):
-        if model["id"] == model_id:
-            return model
-    return None
+    """获取模型信息（从内存中的模型注册表查找）"""
+    models_cfg = models_config_cache.get()
+    if _model_index["version"] != models_config_cache.version:
+        _model_index["models"] = {model["id"]: model for model in models_cfg.get("models", [])}
+        _model_index["version"] = models_config_cache.version
+    return _model_index["models"].get(model_id)
+
+history_store = HistoryStore(HISTORY_DB, legacy_file=HISTORY_FILE)
+
+# ============ Metrics ============
+
+metrics_registry = Registry()
+# 阶段：queue_wait / model_load / swap_in / text_encode / first_step / denoise_step / preview / vae_decode / image_encode / serialize / total
+# first_step 为管线调用到第一个步进回调（管线准备 + 第一步），之后每两次回调之间记一次 denoise_step
+STAGE_SECONDS = metrics_registry.histogram(
+    "zimage_stage_seconds", "Latency of each generation stage in seconds", ("stage", "model", "bucket", "endpoint")
+)
+REQUESTS = metrics_registry.counter("zimage_requests", "Generation requests", ("endpoint", "status"))
+OOMS = metrics_registry.counter("zimage_oom", "CUDA out-of-memory errors during generation", ("model", "bucket"))
+CACHE_LOOKUPS = metrics_registry.counter("zimage_cache_lookups", "Result and prompt cache lookups", ("cache", "result"))
+UNLOADS = metrics_registry.counter("zimage_unloads", "Models evicted from or demoted off a device", ("device", "model", "kind"))
+CANCELLATIONS = metrics_registry.counter("zimage_cancellations", "Generations cancelled by the client", ("endpoint", "stage"))
+GPU_SECONDS_SAVED = metrics_registry.counter(
+    "zimage_gpu_seconds_saved", "Estimated device seconds saved by cancelled generations", ("model",)
+)
+in_flight_requests = {}  # endpoint -> 正在处理的生成请求数
+in_flight_lock = threading.Lock()
+# 当前请求的入口（MCP 工具通过线程调用 generate_image 时用于区分来源）
+request_endpoint = contextvars.ContextVar("request_endpoint", default="generate")
+# 当前被剖析的请求（推理线程上为同一批次中所有被剖析的请求）
+active_profiles = contextvars.ContextVar("active_profiles", default=())
+
+# 不在编译桶中的尺寸按像素数归入这些粗粒度分类（上限为百万像素），保证指标序列数有界
+SIZE_CLASSES = ((0.25, "<=0.25MP"), (1.0, "<=1MP"), (2.0, "<=2MP"), (4.0, "<=4MP"))
+
+def metric_model(model_id):
+    """指标中的 model 标签：不在模型注册表中的 ID 统一记为 unknown"""
+    model_id = model_id or model_config.get('model_id', 'Tongyi-MAI/Z-Image-Turbo')
+    return model_id if get_model_info(model_id) else "unknown"
+
+def metric_bucket(width, height):
+    """指标中的 bucket 标签：声明的编译桶用精确尺寸，其他尺寸只记粗粒度分类"""
+    for bucket in model_config.get("compile_buckets") or []:
+        if (int(bucket["width"]), int(bucket["height"])) == (width, height):
+            return f"{width}x{height}"
+    megapixels = width * height / 1e6
+    return next((name for limit, name in SIZE_CLASSES if megapixels <= limit), ">4MP")
+
+def request_labels(req, endpoint):
+    return {
+        "model": metric_model(req.model_id),
+        "bucket": metric_bucket(req.width, req.height),
+        "endpoint": endpoint,
+    }
+
+def record_stage(stage, seconds, profiles=None, **labels):
+    """记录阶段耗时到直方图，并追加到被剖析请求的时间线（profiles 为空时取当前上下文）"""
+    STAGE_SECONDS.observe(seconds, stage=stage, **labels)
+    for profile in (active_profiles.get() if profiles is None else profiles):
+        profile.add_span(stage, time.time() - seconds, seconds)
+
+def start_profile(endpoint, header=None):
+    """请求头 X-Profile 为真或按 profile_sample_rate 抽中时开始剖析该请求，并设为当前上下文"""
+    forced = header is not None and header.strip().lower() in ("1", "true", "yes", "on")
+    rate = model_config.get("profile_sample_rate") or 0
+    if not forced and not (rate > 0 and random.random() < rate):
+        return None
+    profile = RequestProfile(model_config.get("profile_dir") or "profiles", endpoint, "header" if forced else "sampled")
+    active_profiles.set((profile,))
+    return profile
+
+class track_request:
+    """统计一次生成请求的在途数量、总耗时和结果状态；profile 给出时在结束后写出剖析结果"""
+    def __init__(self, labels, profile=None):
+        self.labels = labels
+        self.profile = profile
+
+    def __enter__(self):
+        self.start = time.time()
+        with in_flight_lock:
+            in_flight_requests[self.labels["endpoint"]] = in_flight_requests.get(self.labels["endpoint"], 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with in_flight_lock:
+            in_flight_requests[self.labels["endpoint"]] -= 1
+        record_stage("total", time.time() - self.start, **self.labels)
+        if exc_type is None:
+            status = "ok"
+        elif issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+            status = "cancelled"
+        else:
+            status = "error"
+        REQUESTS.inc(endpoint=self.labels["endpoint"], status=status)
+        if self.profile is not None:
+            self.profile.meta.update(self.labels)
+            try:
+                self.profile.finish(status, model_config.get("profile_max_traces", 50))
+            except Exception as e:
+                print(f"Failed to save profile {self.profile.id}: {e}")
+        return False
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
 
 model_config = load_config()
 if "cpu_offload" not in model_config:
@@ -131,165 +363,1718 @@ if "compile_model" not in model_config:
     model_config["compile_model"] = False
 if "keep_in_memory" not in model_config:
     model_config["keep_in_memory"] = False  # 新增：内存常驻模式
+if "batch_generation" not in model_config:
+    model_config["batch_generation"] = True  # 多张图片合并为一次前向推理
+if "max_batch_size" not in model_config:
+    model_config["max_batch_size"] = 8
+if "batch_max_wait_ms" not in model_config:
+    model_config["batch_max_wait_ms"] = 50  # 跨请求合批的等待窗口
+if "batch_limit_recovery" not in model_config:
+    model_config["batch_limit_recovery"] = 20  # OOM 下调批次上限后，连续成功多少次再翻倍试探
+if "result_ttl" not in model_config:
+    model_config["result_ttl"] = 600  # 生成结果保留时间（秒）
+if "result_store_max_mb" not in model_config:
+    model_config["result_store_max_mb"] = 512
+if "result_spill_dir" not in model_config:
+    model_config["result_spill_dir"] = None  # 设置后超出内存预算的结果写入磁盘而不是丢弃
+if "image_store_max_mb" not in model_config:
+    model_config["image_store_max_mb"] = 1024
+if "encode_workers" not in model_config:
+    model_config["encode_workers"] = 2  # 图片编码进程数
+if "prompt_cache" not in model_config:
+    model_config["prompt_cache"] = True  # 缓存文本编码结果
+if "prompt_cache_mb" not in model_config:
+    model_config["prompt_cache_mb"] = 256
+if "prompt_cache_device" not in model_config:
+    model_config["prompt_cache_device"] = "cpu"  # "cpu" 或 "gpu"
+if "result_cache" not in model_config:
+    model_config["result_cache"] = True  # 固定 seed 请求的确定性结果缓存
+if "result_cache_mb" not in model_config:
+    model_config["result_cache_mb"] = 256
+if "result_cache_dir" not in model_config:
+    model_config["result_cache_dir"] = "result_cache"  # 磁盘层，设为 null 仅使用内存层
+if "result_cache_disk_mb" not in model_config:
+    model_config["result_cache_disk_mb"] = 2048
+if "model_pool_max_models" not in model_config:
+    model_config["model_pool_max_models"] = 3  # 同时常驻的模型数量上限
+if "model_pool_gpu_gb" not in model_config:
+    model_config["model_pool_gpu_gb"] = None  # 为空时使用显存总量的 90%
+if "model_pool_cpu_gb" not in model_config:
+    model_config["model_pool_cpu_gb"] = None  # 为空时使用物理内存的 50%
+if "compile_buckets" not in model_config:
+    # compile_model 开启时在加载阶段编译并预热的分辨率/批次桶
+    model_config["compile_buckets"] = [{"width": 1024, "height": 1024, "batch": 1}]
+if "bucket_snap_tolerance" not in model_config:
+    model_config["bucket_snap_tolerance"] = 64  # 请求尺寸与最近预热桶相差不超过该像素数时对齐
+if "compile_cache_dir" not in model_config:
+    model_config["compile_cache_dir"] = "compile_cache"
+if "fast_load" not in model_config:
+    model_config["fast_load"] = True  # mmap 读取 safetensors（low_cpu_mem_usage）
+if "prepared_snapshots" not in model_config:
+    model_config["prepared_snapshots"] = False  # 在 cache_dir/prepared 下保存转换好精度的本地快照
+if "pinned_memory" not in model_config:
+    model_config["pinned_memory"] = True  # 内存常驻模式下使用锁页内存按组件异步换入
+if "preload_models" not in model_config:
+    model_config["preload_models"] = []  # 启动时在后台预加载的模型ID列表
+if "preload_warmup" not in model_config:
+    model_config["preload_warmup"] = True  # 预加载后跑一次单步推理预热
+if "warmup_resolution" not in model_config:
+    model_config["warmup_resolution"] = 512
+if "idle_policy" not in model_config:
+    # 空闲卸载策略：fixed / arrival_rate / schedule，可通过 /settings/idle-policy 运行时修改
+    model_config["idle_policy"] = {"policy": "fixed", "idle_timeout": 30}
+if "devices" not in model_config:
+    model_config["devices"] = None  # 为空时使用所有可见的 GPU，例如 ["cuda:0", "cuda:1"]
+if "profile_sample_rate" not in model_config:
+    model_config["profile_sample_rate"] = 0.0  # 随机剖析的请求比例，请求头 X-Profile: 1 总是剖析
+if "profile_dir" not in model_config:
+    model_config["profile_dir"] = "profiles"
+if "profile_max_traces" not in model_config:
+    model_config["profile_max_traces"] = 50  # 只保留最近的剖析结果
+if "job_db" not in model_config:
+    model_config["job_db"] = "jobs.db"  # 异步任务队列（SQLite），重启后继续执行
+if "job_dir" not in model_config:
+    model_config["job_dir"] = "jobs"  # 异步任务的结果图片
+if "job_concurrency" not in model_config:
+    model_config["job_concurrency"] = 4  # 同时提交给调度器的任务数，调度器仍会把它们合批
+if "job_ttl" not in model_config:
+    model_config["job_ttl"] = 86400  # 已结束任务及其图片的保留时间（秒）
+if "preview_max_share" not in model_config:
+    model_config["preview_max_share"] = 0.1  # 潜空间预览最多占用的去噪时间比例
+if "preview_max_size" not in model_config:
+    model_config["preview_max_size"] = 256  # 预览图最长边（像素）
+if "preview_quality" not in model_config:
+    model_config["preview_quality"] = 60
+
+class FixedTimeoutPolicy:
+    """空闲超过 idle_timeout 秒即卸载"""
+    name = "fixed"
+
+    def __init__(self, cfg):
+        self.timeout = cfg.get("idle_timeout", 30)
+
+    def decide(self, model_id, idle_time, arrivals, reload_cost, now):
+        if idle_time >= self.timeout:
+            return True, f"idle {idle_time:.0f}s >= {self.timeout}s"
+        return False, f"idle {idle_time:.0f}s < {self.timeout}s"
+
+class ArrivalRatePolicy:
+    """按观测到的到达率估计 arrival_horizon 秒内有请求的概率 P，
+    预期重载代价 P × 重载耗时低于 reload_cost_budget 秒时卸载。
+
+    到达率 = 最近请求数 / 最早一次请求至今的时间，空闲越久估计值越低；
+    空闲少于 min_idle 秒不卸载，超过 max_idle 秒一定卸载。
+    """
+    name = "arrival_rate"
+
+    def __init__(self, cfg):
+        self.horizon = cfg.get("arrival_horizon", 300)
+        self.budget = cfg.get("reload_cost_budget", 1.0)
+        self.min_idle = cfg.get("min_idle", 30)
+        self.max_idle = cfg.get("max_idle", 3600)
+
+    def decide(self, model_id, idle_time, arrivals, reload_cost, now):
+        if idle_time < self.min_idle:
+            return False, f"idle {idle_time:.0f}s < min_idle {self.min_idle}s"
+        if idle_time >= self.max_idle:
+            return True, f"idle {idle_time:.0f}s >= max_idle {self.max_idle}s"
+        rate = len(arrivals) / max(now - arrivals[0], 1.0) if arrivals else 0.0
+        probability = 1 - math.exp(-rate * self.horizon)
+        expected = probability * reload_cost
+        reason = f"P(request in {self.horizon}s)={probability:.2f}, expected reload {expected:.1f}s vs budget {self.budget}s"
+        return expected < self.budget, reason
+
+def parse_clock(value):
+    """解析 "HH:MM" 格式的时刻，格式不对时抛出 ValueError"""
+    return datetime.strptime(value, "%H:%M").time()
+
+class SchedulePolicy:
+    """按时间段使用不同的空闲超时，例如工作时间常驻、夜间尽快卸载
+
+    schedule: [{"start": "09:00", "end": "18:00", "timeout": 3600}, ...]，可跨午夜；
+    不在任何时间段内时使用 schedule_default_timeout。
+    """
+    name = "schedule"
 
-pipe = None
-pipe_on_gpu = False  # 跟踪模型是否在GPU上
-last_used_time = None  # 跟踪最后使用时间
-current_model_id = None  # 当前加载的模型ID
-IDLE_TIMEOUT = 30  # 5分钟空闲超时
-
-async def auto_unload_monitor():
-    """后台任务：监控并自动卸载空闲模型"""
-    global last_used_time
-    while True:
-        await asyncio.sleep(10)  # 每分钟检查一次
-        if last_used_time and pipe is not None:
-            idle_time = time.time() - last_used_time
-            if idle_time >= IDLE_TIMEOUT:
+    def __init__(self, cfg):
+        self.schedule = []  # [(开始时间, 结束时间, 超时)]，时间为 datetime.time
+        for window in cfg.get("schedule") or []:
+            try:
+                self.schedule.append((parse_clock(window["start"]), parse_clock(window["end"]), window["timeout"]))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Ignoring invalid schedule window {window}: {e}")
+        self.default_timeout = cfg.get("schedule_default_timeout", 30)
+
+    def timeout_at(self, now):
+        current = datetime.fromtimestamp(now).time()
+        for start, end, timeout in self.schedule:
+            inside = start <= current < end if start <= end else (current >= start or current < end)
+            if inside:
+                return timeout
+        return self.default_timeout
+
+    def decide(self, model_id, idle_time, arrivals, reload_cost, now):
+        timeout = self.timeout_at(now)
+        return idle_time >= timeout, f"idle {idle_time:.0f}s vs scheduled timeout {timeout}s"
+
+IDLE_POLICIES = {
+    FixedTimeoutPolicy.name: FixedTimeoutPolicy,
+    ArrivalRatePolicy.name: ArrivalRatePolicy,
+    SchedulePolicy.name: SchedulePolicy,
+}
+
+class IdleManager:
+    """空闲卸载策略的运行时状态：到达记录、决策日志与避免的重载次数
+
+    策略按 model_config["idle_policy"] 每次检查时重新构建，通过 /settings/idle-policy 修改后立即生效。
+    "避免的重载"指请求命中了一个按 idle_timeout 固定超时本应已被卸载的常驻模型。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.arrivals = {}  # (设备, 模型) -> 最近的请求时间
+        self.decisions = deque(maxlen=100)
+        self.counters = {"unloads": 0, "kept_past_timeout": 0, "avoided_reloads": 0}
+        self._kept = set()  # 本次空闲期内已记录过“保留”决策的 (设备, 模型)
+
+    def policy(self):
+        cfg = model_config.get("idle_policy") or {}
+        return IDLE_POLICIES.get(cfg.get("policy", "fixed"), FixedTimeoutPolicy)(cfg)
+
+    def record_arrival(self, pool, model_id, now):
+        key = (pool.device.name, model_id)
+        with self._lock:
+            self.arrivals.setdefault(key, deque(maxlen=64)).append(now)
+            if key in self._kept:
+                self._kept.discard(key)
+                self.counters["avoided_reloads"] += 1
+
+    def reload_cost(self, pool, model_id):
+        pool.resolve_swap_ins()
+        stats = pool.model_stats.get(model_id, {})
+        if model_config.get("keep_in_memory", False) and stats.get("last_swap_in_seconds") is not None:
+            return stats["last_swap_in_seconds"]
+        return stats.get("last_load_seconds") or 10.0
+
+    def check(self, pool):
+        """在推理线程上执行：按策略逐个决定该设备上空闲的模型是否卸载"""
+        policy = self.policy()
+        baseline = (model_config.get("idle_policy") or {}).get("idle_timeout", 30)
+        now = time.time()
+        for entry in list(pool.models.values()):
+            if not entry.uses_gpu_budget and model_config.get("keep_in_memory", False):
+                continue  # 已在内存中，无需再处理
+            key = (pool.device.name, entry.model_id)
+            idle_time = now - entry.last_used
+            with self._lock:
+                arrivals = list(self.arrivals.get(key, ()))
+            unload, reason = policy.decide(entry.model_id, idle_time, arrivals, self.reload_cost(pool, entry.model_id), now)
+            if unload:
+                self._record(pool, entry.model_id, policy.name, "unload", reason, idle_time)
+                with self._lock:
+                    self.counters["unloads"] += 1
+                    self._kept.discard(key)
                 if model_config.get("keep_in_memory", False):
                     # 内存常驻模式：只从GPU移到CPU
-                    unload_from_gpu()
-                    print(f"Auto-unloaded from GPU after {idle_time:.0f}s idle")
+                    pool.demote(entry)
                 else:
-                    # 普通模式：完全卸载
-                    unload_model()
-                    print(f"Auto-unloaded model after {idle_time:.0f}s idle")
-                last_used_time = None
+                    pool.evict(entry.model_id)
+                print(f"Auto-unloaded {entry.model_id} on {pool.device.name} after {idle_time:.0f}s idle ({reason})")
+            elif idle_time >= baseline and key not in self._kept:
+                # 固定超时本应卸载、策略选择保留时记录一次
+                self._record(pool, entry.model_id, policy.name, "keep", reason, idle_time)
+                with self._lock:
+                    self.counters["kept_past_timeout"] += 1
+                    self._kept.add(key)
+
+    def _record(self, pool, model_id, policy, decision, reason, idle_time):
+        self.decisions.append({
+            "time": datetime.now().isoformat(),
+            "device": pool.device.name,
+            "model": model_id,
+            "policy": policy,
+            "decision": decision,
+            "idle_seconds": round(idle_time, 1),
+            "reason": reason,
+        })
+
+    def stats(self):
+        with self._lock:
+            return {
+                "config": model_config.get("idle_policy"),
+                "counters": dict(self.counters),
+                "decisions": list(self.decisions),
+            }
+
+idle_manager = IdleManager()
+
+def unload_if_idle(pool):
+    """在推理线程上执行：按空闲策略卸载该设备上的空闲模型"""
+    if pool.models:
+        idle_manager.check(pool)
+
+async def auto_unload_monitor():
+    """后台任务：按空闲策略监控并自动卸载空闲模型"""
+    while True:
+        await asyncio.sleep(10)  # 每10秒检查一次
+        for worker in scheduler.workers:
+            if worker.pool.models:
+                # 排入该设备的推理线程，避免与正在进行的推理竞争
+                await asyncio.wrap_future(worker.submit_task(unload_if_idle, worker.pool))
+
+class ComputeDevice:
+    """一个推理设备（CUDA GPU 或 CPU），显存信息实时查询"""
+    def __init__(self, name):
+        self.name = name  # "cuda:0"、"cuda:1"、"cpu"
+        self.index = torch.device(name).index
+        self.is_cuda = name.startswith("cuda")
+
+    def total_memory(self):
+        if not self.is_cuda:
+            return None
+        return torch.cuda.get_device_properties(self.index).total_memory
+
+    def free_memory(self):
+        if not self.is_cuda:
+            return None
+        return torch.cuda.mem_get_info(self.index)[0]
+
+    def stats(self):
+        info = {"name": self.name}
+        if self.is_cuda:
+            info["device_name"] = torch.cuda.get_device_name(self.index)
+            info["memory_total"] = self.total_memory()
+            info["memory_free"] = self.free_memory()
+            info["memory_allocated"] = torch.cuda.memory_allocated(self.index)
+        return info
+
+def discover_devices():
+    """枚举本进程可见的 CUDA 设备；没有 GPU 时返回 CPU"""
+    if torch.cuda.is_available():
+        return [ComputeDevice(f"cuda:{i}") for i in range(torch.cuda.device_count())]
+    return [ComputeDevice("cpu")]
+
+# 模型未在 models_config.json 中设置 "devices" 时按类型的默认放置（FLUX.2 显存占用大，默认独占 GPU 1）
+DEFAULT_PLACEMENT = {"flux2": [1]}
+
+def device_matches(device, placement):
+    """placement 为设备名（"cuda:1"、"cpu"）或 GPU 序号组成的列表"""
+    for item in placement:
+        if isinstance(item, int):
+            if device.is_cuda and device.index == item:
+                return True
+        elif item == device.name:
+            return True
+    return False
+
+def get_pipeline_class(model_info):
+    """根据模型类型选择Pipeline类"""
+    if model_info["type"] == "zimage":
+        if ZImagePipeline is None:
+            raise HTTPException(status_code=500, detail="ZImagePipeline not available")
+        return ZImagePipeline
+    elif model_info["type"] == "ovis":
+        if OvisImagePipeline is None:
+            raise HTTPException(status_code=500, detail="OvisImagePipeline not available. Install: pip install git+https://github.com/huggingface/diffusers")
+        return OvisImagePipeline
+    elif model_info["type"] == "flux2":
+        if Flux2Pipeline is None:
+            raise HTTPException(status_code=500, detail="Flux2Pipeline not available")
+        return Flux2Pipeline
+    raise HTTPException(status_code=500, detail=f"Unknown model type: {model_info['type']}")
+
+def pipeline_bytes(pipeline):
+    """统计管线中所有 nn.Module 组件的参数与缓冲区字节数"""
+    total = 0
+    for component in getattr(pipeline, "components", {}).values():
+        if isinstance(component, torch.nn.Module):
+            for tensor in list(component.parameters()) + list(component.buffers()):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+PREPARED_MARKER = "prepared.json"
+
+def prepared_snapshot_dir(model_id, dtype):
+    """已转换精度的本地快照目录：{cache_dir}/prepared/{模型}-{精度}"""
+    root = os.path.join(model_config.get("cache_dir") or ".", "prepared")
+    return os.path.join(root, f"{model_id.replace('/', '--')}-{str(dtype).replace('torch.', '')}")
+
+def resolve_model_path(model_id, dtype):
+    """返回 (加载路径, 是否为准备好的快照)
+
+    优先使用本地准备好的快照，其次是 Hub 本地缓存中的快照目录，都没有时交给 from_pretrained 下载。
+    命中本地时 from_pretrained 直接读目录，不再向 Hub 发请求解析版本。
+    """
+    if model_config.get("prepared_snapshots", False):
+        path = prepared_snapshot_dir(model_id, dtype)
+        if os.path.exists(os.path.join(path, PREPARED_MARKER)):
+            return path, True
+    if os.path.isdir(model_id):
+        return model_id, False
+    try:
+        from huggingface_hub import snapshot_download
+        return snapshot_download(model_id, cache_dir=model_config.get('cache_dir'), local_files_only=True), False
+    except Exception:
+        return model_id, False
+
+def save_prepared_snapshot(pipeline, model_id, dtype):
+    """把已转换精度的管线保存为本地 safetensors 快照，标记文件最后写入"""
+    path = prepared_snapshot_dir(model_id, dtype)
+    tmp_path = path + ".tmp"
+    try:
+        pipeline.save_pretrained(tmp_path, safe_serialization=True)
+        with open(os.path.join(tmp_path, PREPARED_MARKER), "w", encoding="utf-8") as f:
+            json.dump({"model_id": model_id, "dtype": str(dtype), "created": datetime.now().isoformat()}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        print(f"Prepared snapshot saved to {path}")
+    except Exception as e:
+        print(f"Failed to save prepared snapshot for {model_id}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
 
-def get_pipeline(requested_model_id=None):
-    global pipe, pipe_on_gpu, last_used_time, current_model_id
+def load_pipeline(model_id, model_info, device):
+    """从磁盘加载管线到指定设备，返回 ResidentModel
+
+    models_config.json 中模型的 "offload" 可设为 "sequential" / "model"，
+    未设置时 FLUX.2 默认使用 sequential CPU offload，其他模型跟随全局 cpu_offload 配置。
+    加载耗时按 resolve（定位权重）/ read（读取，首次加载包含精度转换）/
+    convert（写出转换好精度的本地快照）/ move（迁移到设备）记录在 load_breakdown 中。
+    """
+    pipeline_class = get_pipeline_class(model_info)
+    print(f"Loading model {model_id} ({model_info['name']}) on {device.name}...")
+    breakdown = {"resolve": 0.0, "read": 0.0, "convert": 0.0, "move": 0.0}
+    
+    dtype = torch.bfloat16 if device.is_cuda else torch.float32
+    start = time.time()
+    path, prepared = resolve_model_path(model_id, dtype)
+    breakdown["resolve"] = time.time() - start
+    
+    # fast_load：按需 mmap 读取 safetensors，不先在内存中完整实例化一份权重
+    start = time.time()
+    loaded = pipeline_class.from_pretrained(
+        path,
+        torch_dtype=dtype,
+        low_cpu_mem_usage=model_config.get("fast_load", True),
+        cache_dir=model_config.get('cache_dir')
+    )
+    breakdown["read"] = time.time() - start
+    
+    if model_config.get("prepared_snapshots", False) and not prepared:
+        start = time.time()
+        save_prepared_snapshot(loaded, model_id, dtype)
+        breakdown["convert"] = time.time() - start
+    
+    start = time.time()
+    offload = model_info.get("offload")
+    if offload is None:
+        if model_info["type"] == "flux2":
+            offload = "sequential"
+        elif model_config.get("cpu_offload", False):
+            offload = "model"
     
+    if offload == "sequential" and device.is_cuda:
+        # 使用 sequential CPU offload，权重按层换入指定的 GPU
+        print(f"Enabling sequential CPU offload on {device.name}...")
+        loaded.enable_sequential_cpu_offload(gpu_id=device.index)
+        on_gpu, movable, pinned = True, False, None
+    else:
+        movable = device.is_cuda
+        pinned = None
+        if model_config.get("keep_in_memory", False) or not device.is_cuda:
+            loaded.to("cpu")
+            on_gpu = False
+            if device.is_cuda:
+                if model_config.get("pinned_memory", True):
+                    pinned = PinnedWeights(loaded)
+                print(f"Model loaded to CPU memory (keep_in_memory mode, pinned: {pinned is not None})")
+        elif offload == "model":
+            print(f"Enabling CPU Offload on {device.name}")
+            loaded.enable_model_cpu_offload(gpu_id=device.index)
+            on_gpu, movable = True, False
+        else:
+            loaded.to(device.name)
+            on_gpu = True
+    breakdown["move"] = time.time() - start
+    
+    if model_config.get("flash_attention", False) and on_gpu:
+        try:
+            loaded.transformer.set_attention_backend("flash")
+            print("Flash Attention enabled")
+        except:
+            print("Flash Attention not available")
+    
+    if model_config.get("compile_model", False):
+        print("Compiling model (buckets are warmed after load)...")
+        try:
+            enable_compile_cache()
+            loaded.transformer.compile()
+        except:
+            print("Model compilation not supported for this model type")
+        
+    breakdown = {phase: round(seconds, 3) for phase, seconds in breakdown.items()}
+    print(f"Model loaded (GPU: {on_gpu}, prepared: {prepared}, breakdown: {breakdown})")
+    entry = ResidentModel(model_id, loaded, on_gpu, movable, pinned)
+    entry.load_breakdown = breakdown
+    return entry
+
+# 组件首次被用到的先后顺序：文本编码器最先，transformer 其次，VAE 最后
+SWAP_IN_ORDER = ("text_encoder", "text_encoder_2", "transformer", "vae")
+
+def plan_swap_in(component_names):
+    """返回组件的换入顺序（纯函数，无需 GPU 即可测试）"""
+    rank = {name: i for i, name in enumerate(SWAP_IN_ORDER)}
+    return sorted(component_names, key=lambda name: rank.get(name, len(SWAP_IN_ORDER)))
+
+class PinnedWeights:
+    """内存常驻模式下把管线权重保存在锁页内存中，按组件异步换入 GPU
+
+    换入时各组件的拷贝按 plan_swap_in 的顺序排入单独的 CUDA 流，每个组件在第一次前向之前
+    才等待自己的拷贝完成，因此文本编码可以在 transformer / VAE 仍在拷贝时开始。
+    推理不修改权重，换出时直接把参数指回锁页副本，不需要再拷贝回内存。
+    """
+    def __init__(self, pipeline):
+        self.components = {
+            name: module for name, module in pipeline.components.items()
+            if isinstance(module, torch.nn.Module)
+        }
+        self.device = None
+        self.host = {}
+        pin = torch.cuda.is_available()
+        for name, module in self.components.items():
+            tensors = {}
+            for key, tensor in self._tensors(module):
+                data = tensor.data
+                if pin and not data.is_pinned():
+                    data = data.pin_memory()
+                tensor.data = data
+                tensors[key] = data
+            self.host[name] = tensors
+        self.timings = {name: {"swap_in_ms": None, "swap_out_ms": None} for name in self.components}
+        self._pending = {}  # name -> (开始事件, 结束事件)，计时在查询时再解析
+        self._span = None  # 最近一次 CUDA 换入的 (第一个开始事件, 最后一个结束事件)
+        self._hooks = {}
+
+    @staticmethod
+    def _tensors(module):
+        for key, param in module.named_parameters():
+            yield "param:" + key, param
+        for key, buf in module.named_buffers():
+            yield "buffer:" + key, buf
+
+    def _move(self, name, device, non_blocking):
+        host = self.host[name]
+        for key, tensor in self._tensors(self.components[name]):
+            tensor.data = host[key].to(device, non_blocking=non_blocking)
+
+    def _wait_before_use(self, name, event, compute_stream):
+        """在组件（及其子模块）第一次前向前让计算流等待该组件的拷贝完成"""
+        handles = []
+        def hook(module, args):
+            compute_stream.wait_event(event)
+            for handle in handles:
+                handle.remove()
+        for module in self.components[name].modules():
+            handles.append(module.register_forward_pre_hook(hook))
+        self._hooks[name] = handles
+
+    def swap_in(self, device):
+        self.device = torch.device(device)
+        order = plan_swap_in(list(self.components))
+        if self.device.type != "cuda":
+            for name in order:
+                start = time.perf_counter()
+                self._move(name, self.device, non_blocking=False)
+                self.timings[name]["swap_in_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            return
+        compute_stream = torch.cuda.current_stream(self.device)
+        copy_stream = torch.cuda.Stream(self.device)
+        copy_stream.wait_stream(compute_stream)
+        first = None
+        with torch.cuda.stream(copy_stream):
+            for name in order:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record(copy_stream)
+                self._move(name, self.device, non_blocking=True)
+                end.record(copy_stream)
+                self._pending[name] = (start, end)
+                self._wait_before_use(name, end, compute_stream)
+                first = first or start
+        self._span = (first, end) if first is not None else None
+
+    def swap_in_seconds(self, wait=False):
+        """最近一次 CUDA 换入的实际拷贝耗时（秒）；拷贝尚未完成且 wait=False 时返回 None"""
+        if self._span is None:
+            return None
+        start, end = self._span
+        if wait:
+            end.synchronize()
+        elif not end.query():
+            return None
+        return start.elapsed_time(end) / 1000
+
+    def swap_out(self):
+        if self.device is not None and self.device.type == "cuda":
+            # 确保拷贝与推理都已结束，再释放显存中的权重
+            torch.cuda.synchronize(self.device)
+        for name, module in self.components.items():
+            for handle in self._hooks.pop(name, []):
+                handle.remove()
+            start = time.perf_counter()
+            host = self.host[name]
+            for key, tensor in self._tensors(module):
+                tensor.data = host[key]
+            self.timings[name]["swap_out_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        self.device = None
+
+    def stats(self):
+        for name, (start, end) in list(self._pending.items()):
+            if end.query():
+                self.timings[name]["swap_in_ms"] = round(start.elapsed_time(end), 2)
+                del self._pending[name]
+        return copy.deepcopy(self.timings)
+
+class ResidentModel:
+    """模型池中的一个常驻管线"""
+    def __init__(self, model_id, pipeline, on_gpu, movable, pinned=None):
+        self.model_id = model_id
+        self.pipe = pipeline
+        self.on_gpu = on_gpu
+        # 启用 CPU offload 的管线由 accelerate 管理设备，不能整体 .to() 迁移
+        self.movable = movable
+        self.pinned = pinned  # 内存常驻模式下的锁页权重（PinnedWeights）
+        self.bytes = pipeline_bytes(pipeline)
+        self.last_used = time.time()
+        self.load_breakdown = None  # 加载各阶段耗时（秒）
+        self.buckets = {}  # "宽x高x批次" -> 预热状态与编译耗时
+
+    def move_to(self, device):
+        if self.pinned is None:
+            self.pipe.to(device)
+        elif device == "cpu":
+            self.pinned.swap_out()
+        else:
+            self.pinned.swap_in(device)
+
+    @property
+    def uses_gpu_budget(self):
+        return self.on_gpu and self.movable
+
+    @property
+    def uses_host_budget(self):
+        # 锁页权重换入 GPU 后仍保留完整的内存副本，同时占用内存预算
+        return not self.uses_gpu_budget or self.pinned is not None
+
+def host_cpu_bytes():
+    """所有设备的模型池中驻留在内存里的模型总字节数（内存预算是全机共享的）"""
+    return sum(pool.cpu_bytes() for pool in scheduler.pools())
+
+class ModelPool:
+    """单个设备上的多模型常驻池
+
+    多个管线同时驻留在该设备的显存和/或内存中，超出 model_pool_gpu_gb（每个 GPU）/
+    model_pool_cpu_gb（全机）/ model_pool_max_models（每个设备）预算时按 LRU
+    先把显存中的模型降级到内存，再从内存中淘汰。所有方法只在该设备的推理线程上调用。
+    """
+    def __init__(self, device):
+        self.device = device
+        self.models = OrderedDict()  # model_id -> ResidentModel，按最近使用排序
+        self.model_stats = {}
+        self.active = None  # 最近一次推理使用的模型
+        self.last_used_time = None
+        self._pending_swap_ins = {}  # model_id -> PinnedWeights，异步换入完成后再记录耗时
+        self.states = {}  # model_id -> {"state", "since", "error"}，不在其中的模型为 unloaded
+
+    def state(self, model_id):
+        return self.states.get(model_id, {}).get("state", "unloaded")
+
+    def set_state(self, model_id, state, error=None):
+        """模型状态：unloaded / loading / warming / ready / failed"""
+        if state == "unloaded":
+            self.states.pop(model_id, None)
+        else:
+            self.states[model_id] = {"state": state, "since": time.time(), "error": error}
+
+    def _stats(self, model_id):
+        return self.model_stats.setdefault(model_id, {
+            "loads": 0,
+            "hits": 0,
+            "evictions": 0,
+            "demotions": 0,
+            "swap_ins": 0,
+            "bytes": None,
+            "last_load_seconds": None,
+            "last_load_breakdown": None,
+            "last_swap_in_seconds": None,
+        })
+
+    def gpu_budget(self):
+        if not self.device.is_cuda:
+            return 0
+        if model_config.get("model_pool_gpu_gb") is not None:
+            return int(model_config["model_pool_gpu_gb"] * 1024**3)
+        return int(self.device.total_memory() * 0.9)
+
+    def cpu_budget(self):
+        if model_config.get("model_pool_cpu_gb") is not None:
+            return int(model_config["model_pool_cpu_gb"] * 1024**3)
+        try:
+            return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.5)
+        except (ValueError, OSError, AttributeError):
+            return 64 * 1024**3
+
+    def gpu_bytes(self):
+        return sum(entry.bytes for entry in list(self.models.values()) if entry.uses_gpu_budget)
+
+    def cpu_bytes(self):
+        return sum(entry.bytes for entry in list(self.models.values()) if entry.uses_host_budget)
+
+    def get(self, model_id):
+        self.resolve_swap_ins()
+        entry = self.models.get(model_id)
+        if entry is not None:
+            self.models.move_to_end(model_id)
+            entry.last_used = time.time()
+            self._stats(model_id)["hits"] += 1
+        return entry
+
+    def load(self, model_id, model_info):
+        # 之前加载过的模型用记录的大小预先腾出空间，避免加载峰值超出预算
+        estimate = self._stats(model_id)["bytes"] or 0
+        if model_config.get("keep_in_memory", False) or not self.device.is_cuda:
+            self.make_room(cpu_needed=estimate, new_model=True)
+        else:
+            self.make_room(gpu_needed=estimate, new_model=True)
+        start = time.time()
+        entry = load_pipeline(model_id, model_info, self.device)
+        stats = self._stats(model_id)
+        stats["loads"] += 1
+        stats["bytes"] = entry.bytes
+        stats["last_load_seconds"] = round(time.time() - start, 3)
+        record_stage("model_load", time.time() - start, model=model_id)
+        stats["last_load_breakdown"] = entry.load_breakdown
+        self.models[model_id] = entry
+        self.make_room(keep=model_id)
+        return entry
+
+    def swap_in(self, entry, wait=False):
+        """把内存中的模型移到GPU，返回耗时（秒）
+
+        锁页权重换入 CUDA 设备时只是把拷贝排入拷贝流，墙钟时间不代表耗时：改用 CUDA 事件计时，
+        拷贝完成后由 resolve_swap_ins 记录；wait=True 时当场等待拷贝完成，否则返回 None。
+        """
+        self.make_room(gpu_needed=entry.bytes, keep=entry.model_id)
+        print(f"Moving model {entry.model_id} from CPU to {self.device.name}...")
+        start = time.time()
+        entry.move_to(self.device.name)
+        entry.on_gpu = True
+        self._stats(entry.model_id)["swap_ins"] += 1
+        if entry.pinned is not None and self.device.is_cuda:
+            self._pending_swap_ins[entry.model_id] = entry.pinned
+            self.resolve_swap_ins(wait=wait)
+            return self._stats(entry.model_id)["last_swap_in_seconds"] if wait else None
+        elapsed = time.time() - start
+        self._record_swap_in(entry.model_id, elapsed)
+        return elapsed
+
+    def _record_swap_in(self, model_id, elapsed):
+        self._stats(model_id)["last_swap_in_seconds"] = round(elapsed, 3)
+        record_stage("swap_in", elapsed, model=model_id)
+        print(f"Model {model_id} moved to GPU in {elapsed:.2f}s")
+
+    def resolve_swap_ins(self, wait=False):
+        """记录已完成的异步换入耗时（wait=True 时等待未完成的拷贝）"""
+        for model_id, pinned in list(self._pending_swap_ins.items()):
+            elapsed = pinned.swap_in_seconds(wait=wait)
+            if elapsed is not None:
+                del self._pending_swap_ins[model_id]
+                self._record_swap_in(model_id, elapsed)
+
+    def demote(self, entry):
+        """把GPU上的模型移回内存"""
+        self.resolve_swap_ins(wait=True)
+        print(f"Moving model {entry.model_id} from {self.device.name} to CPU...")
+        entry.move_to("cpu")
+        entry.on_gpu = False
+        self._stats(entry.model_id)["demotions"] += 1
+        UNLOADS.inc(device=self.device.name, model=entry.model_id, kind="demote")
+        if model_config.get("prompt_cache_device") == "gpu":
+            prompt_cache.discard_model(entry.model_id)
+        if self.device.is_cuda:
+            torch.cuda.empty_cache()
+
+    def evict(self, model_id):
+        """从池中完全卸载一个模型"""
+        self.resolve_swap_ins(wait=True)
+        entry = self.models.pop(model_id)
+        if self.active is entry:
+            self.active = None
+        if entry.uses_gpu_budget:
+            entry.move_to("cpu")
+        entry.pipe = None
+        entry.pinned = None
+        del entry
+        self.set_state(model_id, "unloaded")
+        self._stats(model_id)["evictions"] += 1
+        UNLOADS.inc(device=self.device.name, model=model_id, kind="evict")
+        forget_batch_limits(model_id, self.device.name)
+        if not any(model_id in pool.models for pool in scheduler.pools()):
+            prompt_cache.discard_model(model_id)
+        if self.device.is_cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize(self.device.index)
+        print(f"Model {model_id} unloaded from {self.device.name}")
+
+    def make_room(self, gpu_needed=0, cpu_needed=0, keep=None, new_model=False):
+        """按 LRU 顺序腾出显存、内存和模型数量配额，keep 指定的模型不会被动到"""
+        max_models = max(1, int(model_config.get("model_pool_max_models", 3)))
+        while len(self.models) + (1 if new_model else 0) > max_models:
+            victim = next((mid for mid in self.models if mid != keep), None)
+            if victim is None:
+                break
+            self.evict(victim)
+        for entry in list(self.models.values()):
+            if self.gpu_bytes() + gpu_needed <= self.gpu_budget():
+                break
+            if entry.model_id == keep or not entry.uses_gpu_budget:
+                continue
+            # 锁页模型的内存副本已计入内存预算，降级不再额外占用内存
+            demote_bytes = 0 if entry.pinned is not None else entry.bytes
+            if host_cpu_bytes() + demote_bytes + cpu_needed <= self.cpu_budget():
+                self.demote(entry)
+            else:
+                self.evict(entry.model_id)
+        for entry in list(self.models.values()):
+            if host_cpu_bytes() + cpu_needed <= self.cpu_budget():
+                break
+            if entry.model_id == keep or not entry.uses_host_budget:
+                continue
+            self.evict(entry.model_id)
+
+    def stats(self):
+        # 由其他线程读取，先复制一份避免推理线程修改时迭代出错
+        return {
+            "resident": {
+                mid: {
+                    "location": "gpu" if entry.on_gpu else "cpu",
+                    "bytes": entry.bytes,
+                    "pinned": entry.pinned is not None,
+                    "components": entry.pinned.stats() if entry.pinned is not None else None,
+                    "buckets": copy.deepcopy(entry.buckets),
+                }
+                for mid, entry in list(self.models.items())
+            },
+            "states": dict(self.states),
+            "gpu_bytes": self.gpu_bytes(),
+            "gpu_budget": self.gpu_budget(),
+            "cpu_bytes": self.cpu_bytes(),
+            "cpu_budget": self.cpu_budget(),
+            "max_models": model_config.get("model_pool_max_models", 3),
+            "models": copy.deepcopy(self.model_stats),
+        }
+
+def compile_cache_path(model_id):
+    return os.path.join(model_config.get("compile_cache_dir") or "compile_cache", f"{model_id.replace('/', '--')}.bin")
+
+def enable_compile_cache():
+    """让 inductor 的编译产物落盘，重启后复用"""
+    cache_dir = os.path.abspath(model_config.get("compile_cache_dir") or "compile_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    # 每个桶一个形状，避免超过 dynamo 的重编译上限后退回 eager
+    buckets = model_config.get("compile_buckets") or []
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(buckets) + 1)
+
+def load_compile_cache(model_id):
+    path = compile_cache_path(model_id)
+    if os.path.exists(path) and hasattr(torch.compiler, "load_cache_artifacts"):
+        try:
+            with open(path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            print(f"Loaded compile artifacts from {path}")
+        except Exception as e:
+            print(f"Failed to load compile artifacts: {e}")
+
+def save_compile_cache(model_id):
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return
+    try:
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is not None:
+            with open(compile_cache_path(model_id), "wb") as f:
+                f.write(artifacts[0])
+    except Exception as e:
+        print(f"Failed to save compile artifacts: {e}")
+
+def bucket_key(width, height, batch):
+    return f"{width}x{height}x{batch}"
+
+def warm_buckets(pool, entry):
+    """compile_model 开启时为每个声明的分辨率/批次桶编译并预热一次（单步推理）"""
+    model_info = get_model_info(entry.model_id)
+    load_compile_cache(entry.model_id)
+    for bucket in model_config.get("compile_buckets") or []:
+        width, height = int(bucket["width"]), int(bucket["height"])
+        batch = max(1, int(bucket.get("batch", 1)))
+        info = {"width": width, "height": height, "batch": batch, "warm": False, "compile_seconds": None, "error": None}
+        req = GenerateRequest(prompt="warmup", width=width, height=height, steps=1, num_images=batch, model_id=entry.model_id)
+        if batch > int(model_config.get("max_batch_size", 8)):
+            print(f"Bucket batch {batch} exceeds max_batch_size; it is only used after max_batch_size is raised")
+        start = time.time()
+        try:
+            # 整批运行，按声明的批次大小编译，不受 max_batch_size 拆分
+            run_pipeline_batch(entry.pipe, model_info, req, ["warmup"] * batch, [""] * batch, list(range(batch)), pool.device.name,
+                               max_batch=batch)
+            info["warm"] = True
+        except Exception as e:
+            info["error"] = str(e)
+            print(f"Failed to warm bucket {width}x{height} (batch {batch}): {e}")
+        info["compile_seconds"] = round(time.time() - start, 3)
+        entry.buckets[bucket_key(width, height, batch)] = info
+        print(f"Bucket {width}x{height} (batch {batch}) warmed in {info['compile_seconds']}s")
+    save_compile_cache(entry.model_id)
+
+def resolve_bucket(req):
+    """compile_model 开启时把请求尺寸对齐到最近的已预热桶
+
+    与最近的桶在宽或高上相差超过 bucket_snap_tolerance 像素时不对齐，标记为 cold（会触发重新编译）。
+    返回桶信息；未开启编译时返回 None。
+    """
+    if not model_config.get("compile_model", False):
+        return None
+    model_id = req.model_id or model_config.get('model_id', 'Tongyi-MAI/Z-Image-Turbo')
+    warm = [
+        info for pool in scheduler.pools()
+        for entry in [pool.models.get(model_id)] if entry is not None
+        for info in list(entry.buckets.values()) if info["warm"]
+    ]
+    result = {"width": req.width, "height": req.height, "batch": req.num_images, "snapped": False, "warm": False}
+    if not warm:
+        return result
+    nearest = min(warm, key=lambda b: (abs(b["width"] - req.width) + abs(b["height"] - req.height), abs(b["batch"] - req.num_images)))
+    tolerance = model_config.get("bucket_snap_tolerance", 64)
+    if max(abs(nearest["width"] - req.width), abs(nearest["height"] - req.height)) > tolerance:
+        return result
+    if (nearest["width"], nearest["height"]) != (req.width, req.height):
+        req.width, req.height = nearest["width"], nearest["height"]
+        result.update(width=req.width, height=req.height, snapped=True)
+    result["warm"] = any(
+        (b["width"], b["height"], b["batch"]) == (req.width, req.height, req.num_images) for b in warm
+    )
+    return result
+
+def get_pipeline(pool, requested_model_id=None):
     # 更新最后使用时间
-    last_used_time = time.time()
+    pool.last_used_time = time.time()
     
     # 确定要使用的模型ID
     target_model_id = requested_model_id or model_config.get('model_id', 'Tongyi-MAI/Z-Image-Turbo')
+    idle_manager.record_arrival(pool, target_model_id, pool.last_used_time)
     
-    # 如果请求的模型与当前加载的模型不同，先卸载当前模型
-    if pipe is not None and current_model_id != target_model_id:
-        print(f"Switching from {current_model_id} to {target_model_id}")
-        unload_model()
-    
-    if pipe is None:
+    # 已常驻的模型直接复用，不再因切换模型而卸载其他模型
+    entry = pool.get(target_model_id)
+    if entry is None:
         # 获取模型信息
         model_info = get_model_info(target_model_id)
         if not model_info:
+            pool.set_state(target_model_id, "failed", "not found in config")
             raise HTTPException(status_code=404, detail=f"Model {target_model_id} not found in config")
-        
-        # 根据模型类型选择Pipeline类
-        pipeline_class = None
-        if model_info["type"] == "zimage":
-            if ZImagePipeline is None:
-                raise HTTPException(status_code=500, detail="ZImagePipeline not available")
-            pipeline_class = ZImagePipeline
-        elif model_info["type"] == "ovis":
-            if OvisImagePipeline is None:
-                raise HTTPException(status_code=500, detail="OvisImagePipeline not available. Install: pip install git+https://github.com/huggingface/diffusers")
-            pipeline_class = OvisImagePipeline
-        elif model_info["type"] == "flux2":
-            if Flux2Pipeline is None:
-                raise HTTPException(status_code=500, detail="Flux2Pipeline not available")
-            pipeline_class = Flux2Pipeline
-        else:
-            raise HTTPException(status_code=500, detail=f"Unknown model type: {model_info['type']}")
-        
-        print(f"Loading model {target_model_id} ({model_info['name']})...")
-        
-        dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
-        
-        # FLUX.2-dev 使用 GPU 1 (空闲 44GB)
-        if model_info["type"] == "flux2" and torch.cuda.is_available():
-            print("Loading FLUX.2-dev on GPU 1 with CPU offload...")
-            pipe = pipeline_class.from_pretrained(
-                target_model_id,
-                torch_dtype=dtype,
-                cache_dir=model_config.get('cache_dir')
+        pool.set_state(target_model_id, "loading")
+        try:
+            entry = pool.load(target_model_id, model_info)
+            # 模型在内存中（内存常驻模式），先转移到GPU再按桶编译预热
+            if not entry.on_gpu and entry.movable:
+                pool.swap_in(entry)
+            if model_config.get("compile_model", False):
+                pool.set_state(target_model_id, "warming")
+                warm_buckets(pool, entry)
+        except Exception as e:
+            pool.set_state(target_model_id, "failed", str(e))
+            raise
+        pool.set_state(target_model_id, "ready")
+    
+    # 模型在内存中（内存常驻模式或被预算降级），快速转移到GPU
+    if not entry.on_gpu and entry.movable:
+        pool.swap_in(entry)
+    
+    # 已在池中的模型可能因上一次换入/预热失败被标记为 failed，能正常提供服务后恢复为 ready
+    if pool.state(target_model_id) != "ready":
+        pool.set_state(target_model_id, "ready")
+    pool.active = entry
+    return entry.pipe
+
+def unload_from_gpu(pool):
+    """将该设备上的模型从GPU移回CPU（内存常驻模式）"""
+    if not model_config.get("keep_in_memory", False):
+        return
+    for entry in pool.models.values():
+        if entry.uses_gpu_budget:
+            pool.demote(entry)
+            print("Model moved to CPU (kept in memory)")
+
+def unload_model(pool):
+    """完全卸载该设备上的模型"""
+    for model_id in list(pool.models):
+        pool.evict(model_id)
+
+def preload_model_on(pool, model_id, warmup=True):
+    """在推理线程上加载模型，并可选地跑一次单步推理预热（启动预加载使用）"""
+    try:
+        pipeline = get_pipeline(pool, model_id)
+    except Exception as e:
+        pool.set_state(model_id, "failed", getattr(e, "detail", None) or str(e))
+        print(f"Failed to preload {model_id} on {pool.device.name}: {e}")
+        return
+    if not warmup or model_config.get("compile_model", False):
+        # 开启编译时加载过程中已按桶预热
+        return
+    pool.set_state(model_id, "warming")
+    size = model_config.get("warmup_resolution", 512)
+    req = GenerateRequest(prompt="warmup", width=size, height=size, steps=1, model_id=model_id)
+    start = time.time()
+    try:
+        run_pipeline_batch(pipeline, get_model_info(model_id), req, ["warmup"], [""], [0], pool.device.name)
+        print(f"Model {model_id} warmed up on {pool.device.name} in {time.time() - start:.2f}s")
+    except Exception as e:
+        # 预热失败不影响已加载的模型提供服务
+        print(f"Warm-up of {model_id} on {pool.device.name} failed, model stays loaded: {e}")
+    pool.set_state(model_id, "ready")
+
+def active_model():
+    """所有设备中最近使用的模型（用于兼容单模型时代的状态字段）"""
+    entries = [pool.active for pool in scheduler.pools() if pool.active is not None]
+    return max(entries, key=lambda entry: entry.last_used) if entries else None
+
+# 每个 (模型, 设备, 宽, 高) 实际可用的最大批次大小，OOM 后自动下调；
+# 以下调后的大小连续成功 batch_limit_recovery 次后翻倍试探，回到 max_batch_size 时取消限制
+batch_size_limits = {}
+batch_size_successes = {}
+# 每个 (模型, 设备, 宽, 高) 最近测得的单张图片每步耗时，用于估算取消节省的设备时间
+step_seconds_per_image = {}
+cancel_stats = {"queued": 0, "running": 0, "interrupted_batches": 0, "skipped_images": 0, "gpu_seconds_saved": 0.0}
+cancel_stats_lock = threading.Lock()
+
+def record_saved(seconds, model_id, **counts):
+    GPU_SECONDS_SAVED.inc(seconds, model=metric_model(model_id))
+    with cancel_stats_lock:
+        cancel_stats["gpu_seconds_saved"] += seconds
+        for key, value in counts.items():
+            cancel_stats[key] += value
+
+def extract_images(result_obj):
+    """处理不同Pipeline的返回值"""
+    if hasattr(result_obj, 'images') and result_obj.images is not None and len(result_obj.images) > 0:
+        return result_obj.images
+    elif isinstance(result_obj, list) and len(result_obj) > 0:
+        return result_obj
+    raise Exception("Pipeline returned unexpected format")
+
+def to_uint8_arrays(images):
+    """把管线输出的 [0,1] 张量转换为 HWC uint8 数组列表，转换在张量所在设备上完成"""
+    if isinstance(images, torch.Tensor):
+        images = images.mul(255).round_().clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+    elif isinstance(images, np.ndarray) and images.dtype != np.uint8:
+        images = (images * 255).round().clip(0, 255).astype(np.uint8)
+    return list(images)
+
+def build_pipeline_params(model_info, prompts, negative_prompts, req, generators):
+    """根据模型类型构建一次批量推理的参数"""
+    params = {
+        'prompt': prompts,
+        'height': req.height,
+        'width': req.width,
+        'num_inference_steps': req.steps,
+        'guidance_scale': req.guidance_scale,
+        'generator': generators,
+        # 直接取张量输出，跳过管线内部的 PIL 转换，由编码进程池完成编码
+        'output_type': 'pt'
+    }
+    # Flux2Pipeline不支持negative_prompt
+    if model_info and model_info.get('type') != 'flux2':
+        params['negative_prompt'] = negative_prompts
+    return params
+
+class PromptEmbeddingCache:
+    """文本编码结果的 LRU 缓存，键为 (模型ID, 最终提示词, 负面提示词)
+
+    最终提示词已包含 enhance_prompt 的改写；不使用 CFG 时负面提示词记为 None，
+    因此 guidance_scale 为 0 时不会编码负面提示词。
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> (positive, negative, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _size(*tensors):
+        return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0], item[1]
+
+    def put(self, key, positive, negative):
+        size = self._size(positive, negative)
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)[2]
+            self._items[key] = (positive, negative, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._items:
+                self.bytes -= self._items.popitem(last=False)[1][2]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def discard_model(self, model_id):
+        """丢弃某个模型的全部缓存条目"""
+        with self._lock:
+            for key in [k for k in self._items if k[0] == model_id]:
+                self.bytes -= self._items.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+prompt_cache = PromptEmbeddingCache(int(model_config.get("prompt_cache_mb", 256) * 1024**2))
+
+def encode_prompts(pipeline, model_type, prompts, negative_prompts, cfg, device):
+    """批量编码提示词，返回每个提示词的 (正向, 负向或None) embedding（Ovis/FLUX.2 保留 batch 维度 1）"""
+    with torch.no_grad():
+        if model_type == "zimage":
+            positive, negative = pipeline.encode_prompt(
+                prompt=list(prompts),
+                device=device,
+                do_classifier_free_guidance=cfg,
+                negative_prompt=list(negative_prompts) if cfg else None,
             )
-            current_model_id = target_model_id
-            # 使用 sequential CPU offload 并指定 GPU 1
-            print("Enabling sequential CPU offload on GPU 1...")
-            pipe.enable_sequential_cpu_offload(gpu_id=1)
-            pipe_on_gpu = True
-            print("FLUX.2-dev loaded on GPU 1 with CPU offload")
-        else:
-            # 其他模型使用原有逻辑
-            device = "cpu" if model_config.get("keep_in_memory", False) else ("cuda" if torch.cuda.is_available() else "cpu")
-            
-            pipe = pipeline_class.from_pretrained(
-                target_model_id,
-                torch_dtype=dtype,
-                low_cpu_mem_usage=False,
-                cache_dir=model_config.get('cache_dir')
+            return [(positive[i], negative[i] if cfg else None) for i in range(len(prompts))]
+        if model_type == "ovis":
+            positive, negative, _, _ = pipeline.encode_prompt(
+                prompt=list(prompts),
+                negative_prompt=list(negative_prompts) if cfg else None,
+                do_classifier_free_guidance=cfg,
+                device=device,
             )
-            
-            current_model_id = target_model_id
-            
-            if model_config.get("keep_in_memory", False):
-                print("Model loaded to CPU memory (keep_in_memory mode)")
-                pipe.to("cpu")
-                pipe_on_gpu = False
-            elif model_config.get("cpu_offload", False) and torch.cuda.is_available():
-                print("Enabling CPU Offload")
-                pipe.enable_model_cpu_offload()
-                pipe_on_gpu = True
-            else:
-                device = "cuda" if torch.cuda.is_available() else "cpu"
-                pipe.to(device)
-                pipe_on_gpu = (device == "cuda")
-        
-        if model_config.get("flash_attention", False) and pipe_on_gpu:
-            try:
-                pipe.transformer.set_attention_backend("flash")
-                print("Flash Attention enabled")
-            except:
-                print("Flash Attention not available")
-        
-        if model_config.get("compile_model", False):
-            print("Compiling model (first run will be slow)...")
-            try:
-                pipe.transformer.compile()
-            except:
-                print("Model compilation not supported for this model type")
-            
-        print(f"Model loaded (GPU: {pipe_on_gpu})")
+            return [(positive[i:i + 1], negative[i:i + 1] if cfg else None) for i in range(len(prompts))]
+        if model_type == "flux2":
+            positive, _ = pipeline.encode_prompt(prompt=list(prompts), device=device)
+            return [(positive[i:i + 1], None) for i in range(len(prompts))]
+    return None
+
+def prompt_embedding_params(pipeline, model_info, model_id, prompts, negative_prompts, guidance_scale, labels=None, use_cache=True):
+    """用缓存的 embedding 替换 prompt 参数，只编码未命中的提示词；不支持的模型返回 None
+
+    use_cache=False 时不读写缓存，仍在管线外编码，使 text_encode 阶段单独计时。
+    """
+    model_type = model_info.get('type') if model_info else None
+    if model_type not in ("zimage", "ovis", "flux2"):
+        return None
+    # 与各管线内部判断 CFG 的条件保持一致
+    cfg = {"zimage": guidance_scale > 0, "ovis": guidance_scale > 1, "flux2": False}[model_type]
+    device = pipeline._execution_device
+    keys = [(model_id, p, n if cfg else None) for p, n in zip(prompts, negative_prompts)]
     
-    # 如果是内存常驻模式且模型不在GPU上，快速转移到GPU
-    if model_config.get("keep_in_memory", False) and not pipe_on_gpu and torch.cuda.is_available():
-        print("Moving model from CPU to GPU...")
+    entries = {}
+    for key in keys:
+        if key not in entries:
+            entries[key] = prompt_cache.get(key) if use_cache else None
+    missing = [key for key, value in entries.items() if value is None]
+    if use_cache and len(entries) > len(missing):
+        CACHE_LOOKUPS.inc(len(entries) - len(missing), cache="prompt", result="hit")
+    if use_cache and missing:
+        CACHE_LOOKUPS.inc(len(missing), cache="prompt", result="miss")
+    if missing:
         start = time.time()
-        pipe.to("cuda")
-        pipe_on_gpu = True
-        print(f"Model moved to GPU in {time.time()-start:.2f}s")
+        encoded = encode_prompts(pipeline, model_type, [k[1] for k in missing], [k[2] or "" for k in missing], cfg, device)
+        record_stage("text_encode", time.time() - start, **(labels or {"model": model_id}))
+        store_on_gpu = model_config.get("prompt_cache_device") == "gpu"
+        for key, (positive, negative) in zip(missing, encoded):
+            entries[key] = (positive, negative)
+            if not use_cache:
+                continue
+            if not store_on_gpu:
+                positive = positive.to("cpu")
+                negative = negative.to("cpu") if negative is not None else None
+            prompt_cache.put(key, positive, negative)
     
-    return pipe
-
-def unload_from_gpu():
-    """将模型从GPU移回CPU（内存常驻模式）"""
-    global pipe, pipe_on_gpu
-    if pipe is not None and pipe_on_gpu and model_config.get("keep_in_memory", False):
-        print("Moving model from GPU to CPU...")
-        pipe.to("cpu")
-        pipe_on_gpu = False
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        print("Model moved to CPU (kept in memory)")
+    positives = [entries[key][0].to(device, non_blocking=True) for key in keys]
+    negatives = [entries[key][1].to(device, non_blocking=True) for key in keys] if cfg else None
+    if model_type == "zimage":
+        # Z-Image 接受每个提示词一个变长张量的列表
+        params = {'prompt_embeds': positives}
+        if cfg:
+            params['negative_prompt_embeds'] = negatives
+        return params
+    params = {'prompt_embeds': torch.cat(positives)}
+    if cfg:
+        params['negative_prompt_embeds'] = torch.cat(negatives)
+    return params
+
+# 每个模型的 latent -> RGB 线性投影 (weight [D, 3], bias [3])，由该模型第一次完整生成的最终 latents 与解码结果拟合
+latent_projections = {}
+# 每个 (模型, 设备, 宽, 高) 最近一次预览的耗时，作为新请求第一次预览的预算估计
+preview_cost_estimates = {}
+
+def latent_grid(latents, height, width):
+    """把回调中的 latents 整理为 [B, h, w, D] 特征网格；FLUX 类打包成序列的 latents 每个 token 对应一个图块"""
+    if latents.dim() == 5 and latents.shape[2] == 1:
+        latents = latents[:, :, 0]
+    if latents.dim() == 4:
+        return latents.permute(0, 2, 3, 1)
+    if latents.dim() == 3:
+        tokens = latents.shape[1]
+        rows = round(math.sqrt(tokens * height / width))
+        if rows == 0 or tokens % rows:
+            return None
+        return latents.reshape(latents.shape[0], rows, tokens // rows, latents.shape[2])
+    return None
 
-def unload_model():
-    """完全卸载模型"""
-    global pipe, pipe_on_gpu, current_model_id
-    if pipe is not None:
-        # 先移到CPU释放GPU显存
-        if pipe_on_gpu and torch.cuda.is_available():
-            pipe.to("cpu")
-            torch.cuda.empty_cache()
-        del pipe
-        pipe = None
-        pipe_on_gpu = False
-        current_model_id = None
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-        print("Model unloaded from memory")
+def latent_projection(model_info):
+    """models_config.json 中的 "latent_rgb": {"weight": [[r, g, b], ...], "bias": [r, g, b]} 优先于拟合结果"""
+    override = model_info.get("latent_rgb") if model_info else None
+    if override:
+        return torch.tensor(override["weight"], dtype=torch.float32), torch.tensor(override.get("bias", [0.0, 0.0, 0.0]))
+    return latent_projections.get(model_info['id']) if model_info else None
+
+def fit_latent_projection(model_id, latents, images, height, width):
+    """最小二乘拟合 latents 到（缩放到 latent 分辨率的）解码图片的仿射映射"""
+    grid = latent_grid(latents, height, width)
+    if grid is None or not isinstance(images, torch.Tensor):
+        return
+    count, rows, cols, dim = grid.shape
+    target = torch.nn.functional.interpolate(images[:count].float(), size=(rows, cols), mode="area")
+    x = grid.reshape(-1, dim).float().cpu()
+    x = torch.cat([x, torch.ones(len(x), 1)], dim=1)
+    y = target.permute(0, 2, 3, 1).reshape(-1, 3).cpu()
+    solution = torch.linalg.lstsq(x, y).solution
+    latent_projections[model_id] = (solution[:-1].contiguous(), solution[-1].contiguous())
+    print(f"Fitted latent preview projection for {model_id} ({dim} channels)")
+
+def render_previews(projection, latents, height, width, count):
+    """用线性投影把 latents 转为 JPEG data URL 列表；形状与投影不匹配时返回 None"""
+    grid = latent_grid(latents[:count], height, width)
+    weight, bias = projection
+    if grid is None or grid.shape[-1] != weight.shape[0]:
+        return None
+    rgb = (grid.float() @ weight.to(grid.device) + bias.to(grid.device)).clamp_(0, 1).permute(0, 3, 1, 2)
+    max_size = model_config.get("preview_max_size", 256)
+    if max(rgb.shape[-2:]) > max_size:
+        scale = max_size / max(rgb.shape[-2:])
+        rgb = torch.nn.functional.interpolate(rgb, scale_factor=scale, mode="area")
+    arrays = to_uint8_arrays(rgb)
+    quality = model_config.get("preview_quality", 60)
+    return [
+        "data:image/jpeg;base64," + base64.b64encode(encode_array(array, "jpeg", quality=quality)[0]).decode("utf-8")
+        for array in arrays
+    ]
+
+def run_pipeline_batch(pipeline, model_info, req, prompts, negative_prompts, seeds, device, on_step=None, labels=None, is_cancelled=None,
+                       preview_every=0, on_preview=None, max_batch=None):
+    """一次前向推理生成 len(seeds) 张图片，每张图片使用各自的 Generator
+
+    显存不足时自动拆分为更小的子批次重试，并记住该分辨率下可用的批次大小。
+    on_step(step, timestep, done_images) 在每个去噪步结束时由管线回调触发。
+    labels 给出时记录每个去噪步与 VAE 解码（最后一步到管线返回）的耗时。
+    is_cancelled(start, end) 为真表示这段图片的请求都已取消：尚未开始的子批次直接跳过（结果为 None），
+    正在推理的子批次在下一个去噪步边界设置 _interrupt 中断。
+    preview_every > 0 时每 N 步用线性投影生成预览并调用 on_preview(step, previews, done_images, cost)，
+    预览累计耗时超过去噪耗时的 preview_max_share 时跳过该次预览。
+    max_batch 覆盖 batch_generation / max_batch_size 的子批次上限（桶预热按声明的批次整批运行）。
+    """
+    if max_batch is not None:
+        max_batch = max(1, int(max_batch))
+    elif not model_config.get("batch_generation", True):
+        max_batch = 1
+    else:
+        max_batch = max(1, int(model_config.get("max_batch_size", 8)))
+    model_id = model_info['id']
+    key = (model_id, str(device), req.width, req.height)
+    limit = min(len(seeds), max_batch, batch_size_limits.get(key, max_batch))
+
+    images = []
+    start = 0
+    while start < len(seeds):
+        end = start + limit
+        if is_cancelled is not None and is_cancelled(start, end):
+            count = len(seeds[start:end])
+            record_saved(step_seconds_per_image.get(key, 0.0) * req.steps * count, model_id, skipped_images=count)
+            images.extend([None] * count)
+            start += count
+            continue
+        generators = [torch.Generator(device).manual_seed(s) for s in seeds[start:end]]
+        params = build_pipeline_params(
+            model_info,
+            prompts[start:end],
+            negative_prompts[start:end],
+            req,
+            generators,
+        )
+        # 提示词总是在管线外编码（prompt_cache 关闭时不读写缓存），text_encode 与去噪分开计时
+        embeds = prompt_embedding_params(
+            pipeline, model_info, model_id, prompts[start:end], negative_prompts[start:end], req.guidance_scale, labels,
+            use_cache=model_config.get("prompt_cache", True),
+        )
+        if embeds is not None:
+            params.pop('prompt')
+            params.pop('negative_prompt', None)
+            params.update(embeds)
+        chunk_start = time.time()
+        last_step = [None]  # 上一次步进回调的时间；第一次回调之前为 None
+        interrupted = [False]
+        projection = latent_projection(model_info)
+        final_latents = [None]
+        preview_cost = {"spent": 0.0, "last": preview_cost_estimates.get(key, 0.0)}
+
+        def step_callback(pipe_obj, step, timestep, callback_kwargs, done=start, count=len(generators)):
+            now = time.time()
+            if labels is not None:
+                # 第一次回调之前包含管线准备（不支持外部编码的模型还包括提示词编码），单独记为 first_step
+                record_stage("first_step" if last_step[0] is None else "denoise_step", now - (last_step[0] or chunk_start), **labels)
+            last_step[0] = now
+            if on_step is not None:
+                on_step(step + 1, float(timestep), done)
+            latents = callback_kwargs.get("latents")
+            if projection is None and latents is not None and step + 1 == req.steps:
+                final_latents[0] = latents.detach().clone()
+            if (preview_every > 0 and projection is not None and latents is not None
+                    and (step + 1) % preview_every == 0 and step + 1 < req.steps):
+                # 预计耗时（按上一次预览）超出预算时跳过，保证预览占去噪时间的比例有上限
+                budget = model_config.get("preview_max_share", 0.1) * (now - chunk_start - preview_cost["spent"])
+                if preview_cost["spent"] + preview_cost["last"] <= budget:
+                    previews = render_previews(projection, latents, req.height, req.width, count)
+                    cost = time.time() - now
+                    preview_cost["spent"] += cost
+                    preview_cost["last"] = preview_cost_estimates[key] = cost
+                    if labels is not None:
+                        record_stage("preview", cost, **labels)
+                    if previews and on_preview is not None:
+                        on_preview(step + 1, previews, done, cost)
+                    # 预览耗时不计入下一步的去噪耗时
+                    last_step[0] = time.time()
+            if is_cancelled is not None and not interrupted[0] and is_cancelled(done, done + count):
+                # 管线在后续每步开头检查 interrupt 并跳过去噪
+                pipe_obj._interrupt = True
+                interrupted[0] = True
+                remaining = req.steps - step - 1
+                record_saved((now - chunk_start) / (step + 1) * remaining, model_id, interrupted_batches=1)
+                print(f"All requests in batch cancelled, interrupting after step {step + 1}/{req.steps}")
+            return {}
+        params['callback_on_step_end'] = step_callback
+        try:
+            output = extract_images(pipeline(**params))[:len(generators)]
+            if final_latents[0] is not None and not interrupted[0]:
+                try:
+                    fit_latent_projection(model_id, final_latents[0], output, req.height, req.width)
+                except Exception as e:
+                    print(f"Failed to fit latent preview projection: {e}")
+            chunk_images = to_uint8_arrays(output)
+            del output
+            if labels is not None:
+                record_stage("vae_decode", time.time() - (last_step[0] or chunk_start), **labels)
+            if not interrupted[0] and req.steps > 0 and last_step[0] is not None:
+                step_seconds_per_image[key] = (last_step[0] - chunk_start) / (req.steps * len(generators))
+            if key in batch_size_limits and len(generators) == batch_size_limits[key]:
+                recover_batch_limit(key, max_batch)
+        except torch.cuda.OutOfMemoryError:
+            OOMS.inc(model=metric_model(model_id), bucket=metric_bucket(req.width, req.height))
+            if limit == 1:
+                raise
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            limit = max(1, limit // 2)
+            batch_size_limits[key] = limit
+            batch_size_successes.pop(key, None)
+            print(f"OOM with batch of {len(generators)}, retrying with sub-batches of {limit}")
+            continue
+        images.extend(chunk_images)
+        start += len(generators)
+    return images
+
+def recover_batch_limit(key, max_batch):
+    """以下调后的批次大小成功一次；累计 batch_limit_recovery 次后把上限翻倍"""
+    batch_size_successes[key] = batch_size_successes.get(key, 0) + 1
+    if batch_size_successes[key] < max(1, int(model_config.get("batch_limit_recovery", 20))):
+        return
+    batch_size_successes.pop(key, None)
+    limit = batch_size_limits[key] * 2
+    if limit >= max_batch:
+        batch_size_limits.pop(key, None)
+        print(f"Batch size limit for {key} lifted")
+    else:
+        batch_size_limits[key] = limit
+        print(f"Batch size limit for {key} raised to {limit}")
+
+def forget_batch_limits(model_id, device):
+    """模型卸载后显存环境已变，丢弃该模型在该设备上的批次上限"""
+    for key in [key for key in list(batch_size_limits) if key[0] == model_id and key[1] == device]:
+        batch_size_limits.pop(key, None)
+        batch_size_successes.pop(key, None)
+
+class GenerationJob:
+    """调度队列中的一个生成请求"""
+    def __init__(self, req, prompt, seeds):
+        self.req = req
+        self.prompt = prompt
+        self.seeds = seeds
+        self.model_id = req.model_id or model_config.get('model_id', 'Tongyi-MAI/Z-Image-Turbo')
+        self.future = concurrent.futures.Future()
+        self.enqueued_at = time.time()
+        self.listener = None  # 可选：接收步进事件的回调（在工作线程中调用）
+        self.endpoint = request_endpoint.get()
+        self.profiles = active_profiles.get()
+        self.device = None
+        self.cancelled = False
+        self.future.job = self  # cancel_generation 通过 Future 找到任务
+
+    def estimated_seconds(self):
+        """按最近测得的每步耗时估算该请求需要的设备时间，没有测量值时返回 0"""
+        per_image = step_seconds_per_image.get((self.model_id, self.device, self.req.width, self.req.height), 0.0)
+        return per_image * self.req.steps * len(self.seeds)
+
+    def notify(self, event):
+        if self.listener is not None:
+            try:
+                self.listener(event)
+            except Exception as e:
+                print(f"Error delivering event: {e}")
+
+    def batch_key(self):
+        # 只有模型、尺寸、步数和 guidance 都相同的请求才能合并为一次调用
+        return (self.model_id, self.req.width, self.req.height, self.req.steps, self.req.guidance_scale)
+
+class PipelineTask:
+    """在推理线程上按顺序执行的控制操作（加载、卸载、迁移、img2img 等）"""
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.enqueued_at = time.time()
+
+class BatchScheduler:
+    """单个设备上的跨请求动态批处理调度器，同时也是该设备唯一持有管线的推理线程
+
+    请求先进入队列，工作线程取出队首后在 batch_max_wait_ms 窗口内收集兼容的请求，
+    合并为一次批量推理，再把各自的图片交还给对应的调用方。
+    模型的加载、卸载和设备迁移也作为任务排入同一队列，与推理严格串行执行。
+    """
+    def __init__(self, device):
+        self.device = device
+        self.pool = ModelPool(device)
+        self._cond = threading.Condition()
+        self._queue = []
+        self._thread = None
+        self.in_flight_images = 0
+        self.batches_run = 0
+        self.jobs_run = 0
+
+    def _enqueue(self, item):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"inference-worker-{self.device.name}", daemon=True)
+                self._thread.start()
+            self._queue.append(item)
+            self._cond.notify()
+        return item.future
+
+    def submit(self, req, prompt, seeds, listener=None):
+        job = GenerationJob(req, prompt, seeds)
+        job.listener = listener
+        job.device = self.device.name
+        return self._enqueue(job)
+
+    def submit_task(self, fn, *args, **kwargs):
+        """把任意操作排入推理线程，返回 concurrent.futures.Future"""
+        return self._enqueue(PipelineTask(fn, args, kwargs))
+
+    def call(self, fn, *args, **kwargs):
+        """在推理线程上执行 fn 并阻塞等待结果"""
+        if threading.current_thread() is self._thread:
+            return fn(*args, **kwargs)
+        return self.submit_task(fn, *args, **kwargs).result()
+
+    def queue_depth(self):
+        with self._cond:
+            jobs = [item for item in self._queue if isinstance(item, GenerationJob)]
+            return {
+                "requests": len(jobs),
+                "images": sum(len(job.seeds) for job in jobs),
+                "tasks": len(self._queue) - len(jobs),
+            }
+
+    def stats(self):
+        return {
+            **self.queue_depth(),
+            "in_flight_images": self.in_flight_images,
+            "batches_run": self.batches_run,
+            "avg_requests_per_batch": round(self.jobs_run / self.batches_run, 2) if self.batches_run else 0,
+        }
+
+    def _collect(self):
+        """阻塞直到取出一个控制任务，或凑出一批兼容的请求"""
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            head = self._queue[0]
+            if isinstance(head, PipelineTask):
+                self._queue.pop(0)
+                return head if head.future.set_running_or_notify_cancel() else None
+            key = head.batch_key()
+            max_images = max(1, int(model_config.get("max_batch_size", 8)))
+            deadline = head.enqueued_at + model_config.get("batch_max_wait_ms", 50) / 1000
+            while True:
+                batch, images = [], 0
+                for job in self._queue:
+                    # 不越过排在后面的控制任务，保证卸载/迁移与推理的先后顺序
+                    if isinstance(job, PipelineTask):
+                        break
+                    if job.batch_key() != key:
+                        continue
+                    if batch and images + len(job.seeds) > max_images:
+                        continue
+                    batch.append(job)
+                    images += len(job.seeds)
+                remaining = deadline - time.time()
+                if images >= max_images or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            for job in batch:
+                self._queue.remove(job)
+        return [job for job in batch if job.future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while True:
+            item = self._collect()
+            if isinstance(item, PipelineTask):
+                try:
+                    item.future.set_result(item.fn(*item.args, **item.kwargs))
+                except Exception as e:
+                    item.future.set_exception(e)
+            elif item:
+                self._execute(item)
+
+    def _execute(self, jobs):
+        total_images = sum(len(job.seeds) for job in jobs)
+
+        def on_step(step, timestep, done_images):
+            event = {'type': 'step', 'step': step, 'total': jobs[0].req.steps, 'timestep': timestep, 'done_images': done_images, 'total_images': total_images}
+            for job in jobs:
+                job.notify(event)
+
+        preview_every = min((job.req.preview_every for job in jobs if job.req.preview_every > 0), default=0)
+
+        def on_preview(step, previews, done_images, cost):
+            # 预览属于图片 done_images..done_images+len(previews)，分发给对应请求
+            offset = 0
+            for job in jobs:
+                for i, seed in enumerate(job.seeds):
+                    index = offset + i - done_images
+                    if job.req.preview_every > 0 and step % job.req.preview_every == 0 and 0 <= index < len(previews):
+                        job.notify({'type': 'preview', 'step': step, 'total': job.req.steps, 'index': i, 'seed': seed,
+                                    'image': previews[index], 'cost_ms': round(cost * 1000, 2)})
+                offset += len(job.seeds)
+
+        self.in_flight_images = total_images
+        profiles = tuple(profile for job in jobs for profile in job.profiles)
+        token = active_profiles.set(profiles)
+        try:
+            for job in jobs:
+                queue_wait = time.time() - job.enqueued_at
+                record_stage("queue_wait", queue_wait, job.profiles, **request_labels(job.req, job.endpoint))
+                job.notify({'type': 'start', 'queue_wait': round(queue_wait, 3), 'batch_requests': len(jobs), 'device': self.device.name})
+            # 批次中有被剖析的请求时，剖析模型加载/换入与整次推理
+            with BatchProfiler(profiles, self.device.is_cuda):
+                pipeline = get_pipeline(self.pool, jobs[0].model_id)
+                device = self.device.name
+                model_info = get_model_info(jobs[0].model_id)
+                prompts, negative_prompts, seeds = [], [], []
+                for job in jobs:
+                    prompts += [job.prompt] * len(job.seeds)
+                    negative_prompts += [job.req.negative_prompt or ""] * len(job.seeds)
+                    seeds += job.seeds
+                if len(jobs) > 1:
+                    print(f"Batching {len(jobs)} requests ({len(seeds)} images) into one pipeline call")
+                endpoints = {job.endpoint for job in jobs}
+                labels = request_labels(jobs[0].req, endpoints.pop() if len(endpoints) == 1 else "mixed")
+                spans, offset = [], 0
+                for job in jobs:
+                    spans.append((offset, offset + len(job.seeds), job))
+                    offset += len(job.seeds)
+
+                def is_cancelled(start, end):
+                    return all(job.cancelled for first, last, job in spans if first < end and last > start)
+
+                results = run_pipeline_batch(
+                    pipeline, model_info, jobs[0].req, prompts, negative_prompts, seeds, device,
+                    on_step=on_step, labels=labels, is_cancelled=is_cancelled,
+                    preview_every=preview_every, on_preview=on_preview,
+                )
+        except Exception as e:
+            for job in jobs:
+                job.future.set_exception(e)
+            return
+        finally:
+            self.in_flight_images = 0
+            active_profiles.reset(token)
+        self.batches_run += 1
+        self.jobs_run += len(jobs)
+        offset = 0
+        for job in jobs:
+            job.future.set_result(results[offset:offset + len(job.seeds)])
+            offset += len(job.seeds)
+
+class DeviceRouter:
+    """多设备调度：每个设备一个推理线程，请求路由到负载最低的可用设备
+
+    负载按排队和正在推理的图片数衡量，其次优先已常驻该模型的设备，再按实时空闲显存排序。
+    模型在 models_config.json 中的 "devices"（设备名或 GPU 序号列表）限制可用设备。
+    设备发现通过 discover 注入，便于在没有 GPU 的机器上用假设备测试路由逻辑。
+    """
+    def __init__(self, discover=discover_devices):
+        self.discover = discover
+        self._workers = None
+        self._placements = {}  # model_id -> (worker, future)，排到该设备等待加载模型的请求
+        self._lock = threading.RLock()
+
+    @property
+    def workers(self):
+        with self._lock:
+            if self._workers is None:
+                devices = self.discover()
+                allowed = model_config.get("devices")
+                if allowed:
+                    devices = [device for device in devices if device_matches(device, allowed)]
+                self._workers = [BatchScheduler(device) for device in devices]
+                print(f"Inference devices: {[device.name for device in devices]}")
+            return self._workers
+
+    def pools(self):
+        return [worker.pool for worker in self.workers]
+
+    def eligible(self, model_id):
+        model_info = get_model_info(model_id) or {}
+        placement = model_info.get("devices")
+        if placement is None:
+            default = DEFAULT_PLACEMENT.get(model_info.get("type"))
+            # 默认放置的 GPU 不存在（单卡或 CPU）时退回所有设备
+            if default and any(device_matches(worker.device, default) for worker in self.workers):
+                placement = default
+        workers = [worker for worker in self.workers if not placement or device_matches(worker.device, placement)]
+        if not workers:
+            raise HTTPException(status_code=503, detail=f"No device available for model {model_id}")
+        return workers
+
+    def load_score(self, worker, model_id):
+        depth = worker.queue_depth()
+        busy = depth["images"] + depth["tasks"] + worker.in_flight_images
+        free = worker.device.free_memory() or 0
+        return (busy, worker.pool.state(model_id) == "unloaded", -free)
+
+    def route(self, model_id=None):
+        """为模型选择负载最低的设备
+
+        模型正在某个设备上加载（或已有请求排到某个设备等待加载）且尚未在任何设备上就绪时，
+        请求排到该设备等待同一次加载，不会在另一个设备上再加载一份。
+        池中的模型状态只由该设备的推理线程在真正开始加载时修改，路由只通过 place 记下请求的去向；
+        该请求完成、失败或被取消后这条记录自然失效。
+        """
+        model_id = model_id or model_config.get('model_id', 'Tongyi-MAI/Z-Image-Turbo')
+        workers = self.eligible(model_id)
+        with self._lock:
+            states = [worker.pool.state(model_id) for worker in workers]
+            loading = [worker for worker, state in zip(workers, states) if state in ("loading", "warming")]
+            placed, future = self._placements.get(model_id, (None, None))
+            if placed in workers and not future.done() and placed.pool.state(model_id) in ("unloaded", "failed"):
+                loading.append(placed)
+            if loading and "ready" not in states:
+                return min(loading, key=lambda worker: self.load_score(worker, model_id))
+            return min(workers, key=lambda worker: self.load_score(worker, model_id))
+
+    def place(self, model_id, worker, future):
+        """记录排到 worker 上的请求或预加载任务，模型尚未加载时后续请求跟到同一设备"""
+        with self._lock:
+            if worker.pool.state(model_id) in ("unloaded", "failed"):
+                self._placements[model_id] = (worker, future)
+
+    def submit(self, req, prompt, seeds, listener=None):
+        # 路由与入队在同一把锁内完成，后到的请求能看到前一个请求已排到的设备
+        model_id = req.model_id or model_config.get('model_id', 'Tongyi-MAI/Z-Image-Turbo')
+        with self._lock:
+            worker = self.route(model_id)
+            future = worker.submit(req, prompt, seeds, listener=listener)
+            self.place(model_id, worker, future)
+            return future
+
+    def broadcast(self, fn, *args, **kwargs):
+        """在每个设备的推理线程上执行 fn(pool, ...)，返回 Future 列表"""
+        return [worker.submit_task(fn, worker.pool, *args, **kwargs) for worker in self.workers]
+
+    def call_all(self, fn, *args, **kwargs):
+        return [future.result() for future in self.broadcast(fn, *args, **kwargs)]
+
+    def queue_depth(self):
+        total = {"requests": 0, "images": 0, "tasks": 0}
+        for worker in self.workers:
+            for key, value in worker.queue_depth().items():
+                total[key] += value
+        return total
+
+    def stats(self):
+        return {
+            **self.queue_depth(),
+            "max_batch_size": model_config.get("max_batch_size", 8),
+            "max_wait_ms": model_config.get("batch_max_wait_ms", 50),
+            "batches_run": sum(worker.batches_run for worker in self.workers),
+            "avg_requests_per_batch": round(
+                sum(worker.jobs_run for worker in self.workers) / max(1, sum(worker.batches_run for worker in self.workers)), 2
+            ),
+            "devices": {worker.device.name: worker.stats() for worker in self.workers},
+            "cancellations": {key: round(value, 3) for key, value in cancel_stats.items()},
+        }
+
+scheduler = DeviceRouter()
+
+def cancel_generation(future):
+    """取消 scheduler.submit 返回的生成请求
+
+    还在排队时直接从队列中丢弃；已开始推理时标记取消，同一批次中的请求都取消后在下一个去噪步边界中断，
+    尚未开始的子批次直接跳过。已完成的请求不受影响。
+    """
+    job = getattr(future, "job", None)
+    if job is None or job.cancelled:
+        return
+    if future.cancel() or future.cancelled():
+        stage = "queued"
+    elif not future.done():
+        stage = "running"
+    else:
+        return
+    job.cancelled = True
+    CANCELLATIONS.inc(endpoint=job.endpoint, stage=stage)
+    with cancel_stats_lock:
+        cancel_stats[stage] += 1
+    if stage == "queued":
+        record_saved(job.estimated_seconds(), job.model_id)
 
 class SettingsRequest(BaseModel):
     cache_dir: Optional[str] = None
@@ -301,13 +2086,16 @@ class SettingsRequest(BaseModel):
     flash_attention: bool = False
     compile_model: bool = False
 
+# 改变后需要重新加载模型的设置
+LOAD_SETTINGS = ("cache_dir", "cpu_offload", "flash_attention", "compile_model", "keep_in_memory")
+
 @app.post("/settings/model-path")
 async def set_model_path(req: SettingsRequest):
-    global pipe
     try:
         if req.cache_dir and not os.path.exists(req.cache_dir):
             os.makedirs(req.cache_dir, exist_ok=True)
         
+        changed = any(model_config.get(key) != getattr(req, key) for key in LOAD_SETTINGS)
         model_config["cache_dir"] = req.cache_dir
         model_config["cpu_offload"] = req.cpu_offload
         model_config["flash_attention"] = req.flash_attention
@@ -315,9 +2103,9 @@ async def set_model_path(req: SettingsRequest):
         model_config["keep_in_memory"] = req.keep_in_memory
         save_config(model_config)
         
-        # 如果改变了内存常驻模式，需要重新加载
-        if pipe is not None:
-            unload_model()
+        # 只有影响加载方式的设置改变时才需要重新加载
+        if changed and any(pool.models for pool in scheduler.pools()):
+            await asyncio.gather(*[asyncio.wrap_future(f) for f in scheduler.broadcast(unload_model)])
         
         return {"status": "success", "message": "Settings saved"}
     except Exception as e:
@@ -327,6 +2115,113 @@ async def set_model_path(req: SettingsRequest):
 async def get_settings():
     return model_config
 
+class BatchingRequest(BaseModel):
+    batch_generation: Optional[bool] = None  # 未提供的字段保持原值
+    max_batch_size: Optional[int] = None
+    batch_max_wait_ms: Optional[int] = None
+
+@app.get("/settings/batching")
+def get_batching():
+    return {
+        "batch_generation": model_config.get("batch_generation", True),
+        "max_batch_size": model_config.get("max_batch_size", 8),
+        "batch_max_wait_ms": model_config.get("batch_max_wait_ms", 50),
+    }
+
+@app.post("/settings/batching")
+def set_batching(req: BatchingRequest):
+    """运行时调整跨请求合批参数（下一批生效，不会卸载已加载的模型）"""
+    if req.batch_generation is not None:
+        model_config["batch_generation"] = req.batch_generation
+    if req.max_batch_size is not None:
+        model_config["max_batch_size"] = max(1, req.max_batch_size)
+        batch_size_limits.clear()
+        batch_size_successes.clear()
+    if req.batch_max_wait_ms is not None:
+        model_config["batch_max_wait_ms"] = max(0, req.batch_max_wait_ms)
+    save_config(model_config)
+    return {"status": "success", **get_batching()}
+
+class ScheduleWindow(BaseModel):
+    start: str
+    end: str
+    timeout: float
+
+    @field_validator("start", "end")
+    @classmethod
+    def check_clock(cls, value):
+        # 统一为零填充的 HH:MM，"9:00" 之类的写法规范化，"9am" 等无法解析的值返回 422
+        try:
+            return parse_clock(value).strftime("%H:%M")
+        except ValueError:
+            raise ValueError(f"time must be HH:MM, got {value!r}")
+
+class IdlePolicyRequest(BaseModel):
+    policy: Literal["fixed", "arrival_rate", "schedule"] = "fixed"
+    idle_timeout: float = 30  # fixed 策略的超时，也是统计“避免的重载”的基准
+    arrival_horizon: float = 300
+    reload_cost_budget: float = 1.0
+    min_idle: float = 30
+    max_idle: float = 3600
+    schedule: List[ScheduleWindow] = []  # [{"start": "09:00", "end": "18:00", "timeout": 3600}]
+    schedule_default_timeout: float = 30
+
+@app.get("/settings/idle-policy")
+def get_idle_policy():
+    """获取空闲卸载策略、决策记录与避免的重载次数"""
+    return idle_manager.stats()
+
+@app.post("/settings/idle-policy")
+def set_idle_policy(req: IdlePolicyRequest):
+    """运行时切换空闲卸载策略（不会卸载已加载的模型）"""
+    model_config["idle_policy"] = req.model_dump()
+    save_config(model_config)
+    return {"status": "success", "idle_policy": model_config["idle_policy"]}
+
+class ProfilingRequest(BaseModel):
+    sample_rate: float = 0.0  # 0 关闭随机剖析，1 剖析所有请求
+    max_traces: int = 50
+
+@app.get("/settings/profiling")
+def get_profiling():
+    return {
+        "sample_rate": model_config.get("profile_sample_rate", 0.0),
+        "max_traces": model_config.get("profile_max_traces", 50),
+        "dir": model_config.get("profile_dir") or "profiles",
+    }
+
+@app.post("/settings/profiling")
+def set_profiling(req: ProfilingRequest):
+    """运行时修改随机剖析比例；单个请求可以用请求头 X-Profile: 1 强制剖析"""
+    if not 0 <= req.sample_rate <= 1:
+        raise HTTPException(status_code=400, detail="sample_rate must be between 0 and 1")
+    model_config["profile_sample_rate"] = req.sample_rate
+    model_config["profile_max_traces"] = max(1, req.max_traces)
+    save_config(model_config)
+    return {"status": "success", **get_profiling()}
+
+@app.get("/admin/profiles")
+def get_profiles(limit: int = 50):
+    """列出最近的剖析结果（各阶段耗时汇总与可下载的文件）"""
+    return {"profiles": list_profiles(model_config.get("profile_dir") or "profiles")[:limit]}
+
+@app.get("/admin/profiles/{profile_id}")
+def get_profile(profile_id: str):
+    for summary in list_profiles(model_config.get("profile_dir") or "profiles"):
+        if summary["id"] == profile_id:
+            return summary
+    raise HTTPException(status_code=404, detail="Profile not found")
+
+@app.get("/admin/profiles/{profile_id}/{filename}")
+def download_profile_file(profile_id: str, filename: str):
+    """下载剖析文件：stages.trace.json / torch.trace.json（Chrome trace）、cpu.speedscope.json、cpu.pstats 等"""
+    if os.path.basename(profile_id) != profile_id or os.path.basename(filename) != filename:
+        raise HTTPException(status_code=400, detail="Invalid path")
+    path = os.path.join(model_config.get("profile_dir") or "profiles", profile_id, filename)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Profile file not found")
+    return FileResponse(path, filename=f"{profile_id}-{filename}")
+
 class GenerateRequest(BaseModel):
     prompt: str
     negative_prompt: Optional[str] = None
@@ -338,212 +2233,571 @@ class GenerateRequest(BaseModel):
     num_images: int = 1  # Max 8
     enhance_prompt: bool = False
     model_id: Optional[str] = None  # 可选：指定使用的模型
+    legacy_base64: bool = False  # True 时按旧格式在 JSON 中内嵌 base64 图片
+    output_format: Literal["png", "jpeg", "webp", "webp_lossless"] = "png"
+    compress_level: int = 6  # PNG 压缩级别 0-9，越低编码越快
+    quality: int = 90  # JPEG / WebP 质量
+    use_cache: bool = True  # 固定 seed 时是否使用确定性结果缓存
+    stream_images: bool = False  # /generate/stream：每张图片编码完成后立即作为 image 事件发送，不再需要 /get_images
+    preview_every: int = 0  # /generate/stream：每 N 步发送一张低质量 JPEG 潜空间预览，0 关闭
+
+def record_history(req):
+    """追加一条生成历史"""
+    history_store.append({
+        "timestamp": datetime.now().isoformat(),
+        "prompt": req.prompt,
+        "negative_prompt": req.negative_prompt,
+        "model_id": req.model_id or model_config.get('model_id', 'Tongyi-MAI/Z-Image-Turbo'),
+        "params": {
+            "width": req.width,
+            "height": req.height,
+            "steps": req.steps,
+            "guidance_scale": req.guidance_scale,
+            "seed": req.seed
+        }
+    })
 
 @app.post("/generate/stream")
-async def generate_image_stream(req: GenerateRequest):
+async def generate_image_stream(req: GenerateRequest, x_profile: Annotated[Optional[str], Header()] = None):
     if req.height % 16 != 0 or req.width % 16 != 0:
         raise HTTPException(status_code=400, detail="Dimensions must be divisible by 16")
+    bucket = resolve_bucket(req)
 
     async def event_generator():
+        request_endpoint.set("generate_stream")
+        labels = request_labels(req, "generate_stream")
+        profile = start_profile("generate_stream", x_profile)
         try:
-            start_time = time.time()
-            yield f"data: {json.dumps({'type': 'log', 'message': '开始加载模型...'}, ensure_ascii=False)}\n\n"
-            await asyncio.sleep(0)
+            with track_request(labels, profile):
+                start_time = time.time()
+                prompt = req.prompt
+                if req.enhance_prompt:
+                    prompt = f"masterpiece, best quality, highly detailed, {prompt}"
+                    yield f"data: {json.dumps({'type': 'log', 'message': f'增强提示词: {prompt[:50]}...'}, ensure_ascii=False)}\n\n"
+                    await asyncio.sleep(0)
             
-            pipeline = get_pipeline(req.model_id)
-            device = "cuda" if torch.cuda.is_available() else "cpu"
+                if bucket is not None:
+                    state = "已预热" if bucket["warm"] else "未预热，首次推理需要编译"
+                    snapped = "（已对齐）" if bucket["snapped"] else ""
+                    yield f"data: {json.dumps({'type': 'log', 'message': f'分辨率桶 {req.width}x{req.height}{snapped}: {state}'}, ensure_ascii=False)}\n\n"
             
-            yield f"data: {json.dumps({'type': 'log', 'message': f'模型已加载到 {device}'}, ensure_ascii=False)}\n\n"
-            await asyncio.sleep(0)
+                images = []
+                seeds = [
+                    req.seed if req.seed != -1 else torch.randint(0, 2**32, (1,)).item()
+                    for _ in range(req.num_images)
+                ]
             
-            prompt = req.prompt
-            if req.enhance_prompt:
-                prompt = f"masterpiece, best quality, highly detailed, {prompt}"
-                yield f"data: {json.dumps({'type': 'log', 'message': f'增强提示词: {prompt[:50]}...'}, ensure_ascii=False)}\n\n"
-                await asyncio.sleep(0)
+                # 固定 seed 的请求先查确定性结果缓存，命中时不经过调度器和模型
+                cache_key = result_cache_key(req, prompt)
+                # 结果缓存可能落盘，读写都放到线程中，不阻塞事件循环上的其他流
+                cached = await asyncio.to_thread(result_cache.get, cache_key) if cache_key else None
+                if cached is not None:
+                    data, ext = cached
+                    images = [image_payload(data, ext, seed, req.legacy_base64, labels) for seed in seeds]
+                    yield f"data: {json.dumps({'type': 'log', 'message': '命中结果缓存，跳过推理'}, ensure_ascii=False)}\n\n"
+                    if req.stream_images:
+                        for i, payload in enumerate(images):
+                            yield f"data: {json.dumps({'type': 'image', 'index': i, 'total': req.num_images, **payload}, ensure_ascii=False)}\n\n"
+                        images = []
+                    yield f"data: {json.dumps({'type': 'progress', 'progress': 100, 'current': req.num_images, 'total': req.num_images, 'elapsed': round(time.time()-start_time, 2)}, ensure_ascii=False)}\n\n"
+                    await asyncio.sleep(0)
+                else:
+                    queued = scheduler.queue_depth()['requests']
+                    yield f"data: {json.dumps({'type': 'log', 'message': f'批量生成 {req.num_images} 张图片 (前方排队请求: {queued})...'}, ensure_ascii=False)}\n\n"
+                    await asyncio.sleep(0)
             
-            images = []
-            seeds = []
+                    batch_start = time.time()
             
-            for i in range(req.num_images):
-                yield f"data: {json.dumps({'type': 'log', 'message': f'生成第 {i+1}/{req.num_images} 张图片...'}, ensure_ascii=False)}\n\n"
-                await asyncio.sleep(0)
-                
-                seed = req.seed if req.seed != -1 else torch.randint(0, 2**32, (1,)).item()
-                generator = torch.Generator(device).manual_seed(seed)
-                
-                img_start = time.time()
-                
-                # Simulate progress during generation
-                estimated_time = req.steps * 0.15  # Rough estimate
-                progress_interval = estimated_time / 10
-                
-                # Start generation in background
-                import concurrent.futures
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    # 根据模型类型构建参数
-                    model_info = get_model_info(current_model_id)
-                    params = {
-                        'prompt': prompt,
-                        'height': req.height,
-                        'width': req.width,
-                        'num_inference_steps': req.steps,
-                        'guidance_scale': req.guidance_scale,
-                        'generator': generator
-                    }
-                    
-                    # Flux2Pipeline不支持negative_prompt
-                    if model_info and model_info.get('type') != 'flux2':
-                        params['negative_prompt'] = req.negative_prompt or ""
-                    
-                    future = executor.submit(pipeline, **params)
-                    
-                    # Send progress updates while generating
-                    step = 0
-                    while not future.done():
-                        await asyncio.sleep(progress_interval)
-                        step += 1
-                        if step <= 10:
-                            step_progress = min(step * 10, 95)
-                            yield f"data: {json.dumps({'type': 'log', 'message': f'推理中... {step_progress}%'}, ensure_ascii=False)}\n\n"
-                            await asyncio.sleep(0)
-                    
-                    result_obj = future.result()
-                    
-                    # 处理不同Pipeline的返回值
-                    if hasattr(result_obj, 'images') and result_obj.images:
-                        result = result_obj.images[0]
-                    elif isinstance(result_obj, list) and len(result_obj) > 0:
-                        result = result_obj[0]
+                    # 管线步进回调在工作线程中触发，通过 call_soon_threadsafe 推送到事件循环
+                    loop = asyncio.get_running_loop()
+                    events = asyncio.Queue()
+            
+                    def push(event):
+                        loop.call_soon_threadsafe(events.put_nowait, event)
+            
+                    # 提交到调度器，与其他兼容请求合并推理
+                    future = scheduler.submit(req, prompt, seeds, listener=push)
+                    future.add_done_callback(lambda f: push(None))
+            
+                    try:
+                        while True:
+                            event = await events.get()
+                            if event is None:
+                                break
+                            if event['type'] == 'start':
+                                queue_wait, batch_requests = event['queue_wait'], event['batch_requests']
+                                yield f"data: {json.dumps({'type': 'log', 'message': f'开始推理 (排队 {queue_wait:.2f}秒, 合并请求: {batch_requests})'}, ensure_ascii=False)}\n\n"
+                            elif event['type'] == 'step':
+                                event['elapsed'] = round(time.time() - start_time, 2)
+                                step, total = event['step'], event['total']
+                                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+                                yield f"data: {json.dumps({'type': 'log', 'message': f'推理中... 第 {step}/{total} 步'}, ensure_ascii=False)}\n\n"
+                            elif event['type'] == 'preview':
+                                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # 客户端断开：停止排队或正在进行的推理，不再为无人接收的结果占用设备
+                        cancel_generation(future)
+                        raise
+            
+                    results = future.result()
+            
+                    batch_time = time.time() - batch_start
+            
+                    # 所有图片同时提交到编码进程池，事件循环只等待结果
+                    encodings = [asyncio.wrap_future(submit_encode(result, req, labels)) for result in results]
+                    del results
+            
+                    if req.stream_images:
+                        # 按编码完成的先后逐张发送，发送后不再持有图片数据
+                        pending = {encoding: i for i, encoding in enumerate(encodings)}
+                        encodings = None
+                        sent = 0
+                        while pending:
+                            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                            for encoding in sorted(done, key=pending.get):
+                                i = pending.pop(encoding)
+                                data, ext = encoding.result()
+                                payload = image_payload(data, ext, seeds[i], req.legacy_base64, labels)
+                                if cache_key and i == 0:
+                                    await asyncio.to_thread(result_cache.put, cache_key, data, ext)
+                                del data
+                                sent += 1
+                                elapsed = round(time.time()-start_time, 2)
+                                yield f"data: {json.dumps({'type': 'image', 'index': i, 'total': req.num_images, 'elapsed': elapsed, **payload}, ensure_ascii=False)}\n\n"
+                                del payload
+                                yield f"data: {json.dumps({'type': 'progress', 'progress': int(sent/req.num_images*100), 'current': sent, 'total': req.num_images, 'elapsed': elapsed}, ensure_ascii=False)}\n\n"
                     else:
-                        raise Exception("Pipeline returned unexpected format")
-                
-                img_time = time.time() - img_start
-                yield f"data: {json.dumps({'type': 'log', 'message': f'图片 {i+1} 生成完成 (耗时: {img_time:.2f}秒, seed: {seed})'}, ensure_ascii=False)}\n\n"
-                await asyncio.sleep(0)
+                        for i, seed in enumerate(seeds):
+                            yield f"data: {json.dumps({'type': 'log', 'message': f'图片 {i+1} 生成完成 (耗时: {batch_time:.2f}秒, seed: {seed})'}, ensure_ascii=False)}\n\n"
+                            await asyncio.sleep(0)
                 
-                buffered = io.BytesIO()
-                result.save(buffered, format="PNG")
-                img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-                images.append(f"data:image/png;base64,{img_str}")
-                seeds.append(seed)
+                            data, ext = await encodings[i]
+                            images.append(image_payload(data, ext, seed, req.legacy_base64, labels))
+                            if cache_key and i == 0:
+                                await asyncio.to_thread(result_cache.put, cache_key, data, ext)
                 
-                progress = int(((i+1)/req.num_images)*100)
-                elapsed = round(time.time()-start_time, 2)
-                yield f"data: {json.dumps({'type': 'progress', 'progress': progress, 'current': i+1, 'total': req.num_images, 'elapsed': elapsed}, ensure_ascii=False)}\n\n"
-                await asyncio.sleep(0)
+                            progress = int(((i+1)/req.num_images)*100)
+                            elapsed = round(time.time()-start_time, 2)
+                            yield f"data: {json.dumps({'type': 'progress', 'progress': progress, 'current': i+1, 'total': req.num_images, 'elapsed': elapsed}, ensure_ascii=False)}\n\n"
+                            await asyncio.sleep(0)
             
-            total_time = time.time() - start_time
-            yield f"data: {json.dumps({'type': 'log', 'message': f'全部完成！总耗时: {total_time:.2f}秒'}, ensure_ascii=False)}\n\n"
-            await asyncio.sleep(0)
+                total_time = time.time() - start_time
+                yield f"data: {json.dumps({'type': 'log', 'message': f'全部完成！总耗时: {total_time:.2f}秒'}, ensure_ascii=False)}\n\n"
+                await asyncio.sleep(0)
             
-            # Save to history
-            history = load_history()
-            history.append({
-                "timestamp": datetime.now().isoformat(),
-                "prompt": req.prompt,
-                "negative_prompt": req.negative_prompt,
-                "params": {
-                    "width": req.width,
-                    "height": req.height,
-                    "steps": req.steps,
-                    "guidance_scale": req.guidance_scale,
-                    "seed": req.seed
-                }
-            })
-            save_history(history)
+                # Save to history
+                record_history(req)
             
-            # Store images temporarily
-            import uuid
-            session_id = str(uuid.uuid4())
-            temp_data[session_id] = {'images': [{'image': img, 'seed': s} for img, s in zip(images, seeds)], 'time': time.time()}
+                # Store images temporarily（stream_images 模式下图片已逐张发送，不再保存）
+                session_id = None
+                if not req.stream_images:
+                    session_id = str(uuid.uuid4())
+                    result_store.put(session_id, {'images': images, 'time': time.time()})
             
-            yield f"data: {json.dumps({'type': 'complete', 'session_id': session_id, 'elapsed': round(total_time, 2)}, ensure_ascii=False)}\n\n"
+                yield f"data: {json.dumps({'type': 'complete', 'session_id': session_id, 'elapsed': round(total_time, 2), 'cache_hit': cached is not None, 'bucket': bucket, 'profile_id': profile.id if profile else None}, ensure_ascii=False)}\n\n"
             
         except Exception as e:
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)}, ensure_ascii=False)}\n\n"
     
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
+class ResultStore:
+    """有界的临时结果存储
+
+    条目在 TTL 内可以多次读取（页面刷新不会丢失结果）；总字节数超出预算时按 LRU 淘汰，
+    配置了 spill_dir 时被淘汰的条目写入磁盘，仍可在 TTL 内读取。
+    值可以是 bytes 或可 JSON 序列化的对象。
+    """
+    def __init__(self, ttl, max_bytes, spill_dir=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> [value, size, expires_at]
+        self._spilled = {}  # key -> (path, size, expires_at, is_bytes)
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spills = 0
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _drop_spilled(self, key):
+        path = self._spilled.pop(key)[0]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _purge_expired(self, now):
+        for key in [k for k, item in self._items.items() if item[2] <= now]:
+            self.resident_bytes -= self._items.pop(key)[1]
+            self.expirations += 1
+        for key in [k for k, item in self._spilled.items() if item[2] <= now]:
+            self._drop_spilled(key)
+            self.expirations += 1
+
+    def _enforce_budget(self):
+        while self.resident_bytes > self.max_bytes and self._items:
+            key, (value, size, expires_at) = self._items.popitem(last=False)
+            self.resident_bytes -= size
+            self.evictions += 1
+            if self.spill_dir:
+                try:
+                    os.makedirs(self.spill_dir, exist_ok=True)
+                    path = self._spill_path(key)
+                    with open(path, "wb") as f:
+                        f.write(value if isinstance(value, bytes) else json.dumps(value).encode())
+                    self._spilled[key] = (path, size, expires_at, isinstance(value, bytes))
+                    self.spills += 1
+                except Exception as e:
+                    print(f"Error spilling result to disk: {e}")
+
+    def put(self, key, value, size=None, ttl=None):
+        if size is None:
+            size = len(value) if isinstance(value, (bytes, str)) else len(json.dumps(value))
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            if key in self._items:
+                self.resident_bytes -= self._items.pop(key)[1]
+            if key in self._spilled:
+                self._drop_spilled(key)
+            self._items[key] = [value, size, now + (ttl or self.ttl)]
+            self.resident_bytes += size
+            self._enforce_budget()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key][0]
+            if key in self._spilled:
+                path, size, expires_at, is_bytes = self._spilled[key]
+                try:
+                    with open(path, "rb") as f:
+                        raw = f.read()
+                except OSError:
+                    self._spilled.pop(key)
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                return raw if is_bytes else json.loads(raw)
+            self.misses += 1
+            return None
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items:
+                self.resident_bytes -= self._items.pop(key)[1]
+            if key in self._spilled:
+                self._drop_spilled(key)
+
+    def purge_expired(self):
+        with self._lock:
+            self._purge_expired(time.time())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "spilled_entries": len(self._spilled),
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "spills": self.spills,
+            }
+
 # Temporary storage for generated images
-temp_data = {}
+result_store = ResultStore(
+    ttl=model_config.get("result_ttl", 600),
+    max_bytes=int(model_config.get("result_store_max_mb", 512) * 1024**2),
+    spill_dir=model_config.get("result_spill_dir"),
+)
+
+# 按内容寻址的图片存储，键为 "{sha256前32位}.{ext}"
+image_store = ResultStore(
+    ttl=model_config.get("result_ttl", 600),
+    max_bytes=int(model_config.get("image_store_max_mb", 1024) * 1024**2),
+    spill_dir=os.path.join(model_config["result_spill_dir"], "images") if model_config.get("result_spill_dir") else None,
+)
+
+IMAGE_MEDIA_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+encode_pool = None
+
+def get_encode_pool():
+    """图片编码进程池（spawn 启动）
+
+    服务须以 uvicorn main:app 方式启动（直接运行本文件也会转交给 uvicorn），
+    这样子进程只导入 image_encoding，不会重新执行本模块。
+    """
+    global encode_pool
+    if encode_pool is None:
+        encode_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, int(model_config.get("encode_workers", 2))),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return encode_pool
+
+def submit_encode(image, req, labels=None):
+    """提交一张图片到编码进程池，返回 Future[(bytes, ext)]；labels 给出时记录编码耗时（含排队）"""
+    future = get_encode_pool().submit(encode_array, image, req.output_format, req.compress_level, req.quality)
+    if labels is not None:
+        start = time.time()
+        profiles = active_profiles.get()
+        future.add_done_callback(lambda f: record_stage("image_encode", time.time() - start, profiles, **labels))
+    return future
+
+def image_payload(data, ext="png", seed=None, legacy_base64=False, labels=None):
+    """生成响应中的单张图片：默认存入图片存储并返回 URL，legacy_base64 时内嵌 data URL"""
+    start = time.time()
+    if legacy_base64:
+        img_str = base64.b64encode(data).decode("utf-8")
+        payload = {"image": f"data:{IMAGE_MEDIA_TYPES[ext]};base64,{img_str}", "seed": seed}
+    else:
+        image_id = hashlib.sha256(data).hexdigest()[:32]
+        image_store.put(f"{image_id}.{ext}", data)
+        url = f"/images/{image_id}.{ext}"
+        # image 字段保留为 URL，旧前端可以直接作为 <img src> 使用
+        payload = {"id": image_id, "url": url, "image": url, "seed": seed}
+    if labels is not None:
+        record_stage("serialize", time.time() - start, **labels)
+    return payload
+
+def parse_range(header, length):
+    """解析单段 Range 头，返回 (start, end)
+
+    不支持或语法无效的区间（如 bytes=9-2）按 RFC 9110 忽略，返回 None（回退为完整响应）；
+    起点超出文件大小（或后缀长度为 0）时返回 416。
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start_s, _, end_s = spec.strip().partition("-")
+    if not (start_s.isdigit() or start_s == "") or not (end_s.isdigit() or end_s == "") or start_s == end_s == "":
+        return None
+    if start_s == "":
+        start, end = max(0, length - int(end_s)), length - 1
+    else:
+        start = int(start_s)
+        if end_s and int(end_s) < start:
+            return None
+        end = min(int(end_s), length - 1) if end_s else length - 1
+    if start > end or start >= length:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{length}"})
+    return start, end
+
+@app.get("/images/{name}")
+def get_image_file(name: str, request: Request):
+    """按内容 ID 返回原始图片字节，支持 ETag 和 Range"""
+    image_id, _, ext = name.rpartition(".")
+    if ext not in IMAGE_MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail="Image not found")
+    data = image_store.get(name)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    etag = f'"{image_id}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": f"public, max-age={int(image_store.ttl)}, immutable",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    range_header = request.headers.get("range")
+    byte_range = parse_range(range_header, len(data)) if range_header else None
+    if byte_range is None:
+        return Response(content=data, media_type=IMAGE_MEDIA_TYPES[ext], headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+    return Response(content=data[start:end + 1], status_code=206, media_type=IMAGE_MEDIA_TYPES[ext], headers=headers)
+
+class DeterministicResultCache:
+    """固定 seed 请求的确定性结果缓存（内存层 + 磁盘层）
+
+    键为规范化请求参数的 SHA-256。内存层是带字节预算的 LRU，磁盘层按文件 mtime 淘汰最久未使用的条目，
+    服务重启后磁盘层仍然有效。
+    """
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0, ttl=86400):
+        self.memory = ResultStore(ttl=ttl, max_bytes=memory_bytes)
+        self.disk_dir = disk_dir
+        self.disk_bytes_limit = disk_bytes
+        self._lock = threading.Lock()
+        self._disk = OrderedDict()  # 文件名 -> 大小，按最近使用排序
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if disk_dir and os.path.isdir(disk_dir):
+            entries = []
+            for name in os.listdir(disk_dir):
+                path = os.path.join(disk_dir, name)
+                if os.path.isfile(path):
+                    entries.append((os.path.getmtime(path), name, os.path.getsize(path)))
+            for _, name, size in sorted(entries):
+                self._disk[name] = size
+                self.disk_bytes += size
+
+    def get(self, key):
+        """返回 (bytes, ext)，未命中返回 None"""
+        cached = self.memory.get(key)
+        if cached is not None:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(cache="result", result="hit")
+            return cached
+        if self.disk_dir:
+            with self._lock:
+                name = next((n for n in (f"{key}.{ext}" for _, ext in OUTPUT_FORMATS.values()) if n in self._disk), None)
+                if name is not None:
+                    path = os.path.join(self.disk_dir, name)
+                    try:
+                        with open(path, "rb") as f:
+                            data = f.read()
+                        os.utime(path)
+                        self._disk.move_to_end(name)
+                    except OSError:
+                        self.disk_bytes -= self._disk.pop(name)
+                        data = None
+                    if data is not None:
+                        ext = name.rpartition(".")[2]
+                        self.memory.put(key, (data, ext), size=len(data))
+                        self.hits += 1
+                        CACHE_LOOKUPS.inc(cache="result", result="hit")
+                        return data, ext
+        self.misses += 1
+        CACHE_LOOKUPS.inc(cache="result", result="miss")
+        return None
+
+    def put(self, key, data, ext):
+        self.memory.put(key, (data, ext), size=len(data))
+        if not self.disk_dir:
+            return
+        name = f"{key}.{ext}"
+        try:
+            with self._lock:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                with open(os.path.join(self.disk_dir, name), "wb") as f:
+                    f.write(data)
+                self.disk_bytes += len(data) - self._disk.pop(name, 0)
+                self._disk[name] = len(data)
+                while self.disk_bytes > self.disk_bytes_limit and self._disk:
+                    old_name, size = self._disk.popitem(last=False)
+                    self.disk_bytes -= size
+                    try:
+                        os.remove(os.path.join(self.disk_dir, old_name))
+                    except OSError:
+                        pass
+        except Exception as e:
+            print(f"Error writing result cache: {e}")
+
+    def stats(self):
+        memory = self.memory.stats()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "memory_entries": memory["entries"],
+            "memory_bytes": memory["resident_bytes"],
+            "disk_entries": len(self._disk),
+            "disk_bytes": self.disk_bytes,
+        }
+
+result_cache = DeterministicResultCache(
+    memory_bytes=int(model_config.get("result_cache_mb", 256) * 1024**2),
+    disk_dir=model_config.get("result_cache_dir"),
+    disk_bytes=int(model_config.get("result_cache_disk_mb", 2048) * 1024**2),
+)
+
+def result_cache_key(req, prompt):
+    """固定 seed 的请求返回规范化参数的哈希，否则返回 None（不缓存）"""
+    if req.seed == -1 or not req.use_cache or not model_config.get("result_cache", True):
+        return None
+    canonical = {
+        "model_id": req.model_id or model_config.get('model_id', 'Tongyi-MAI/Z-Image-Turbo'),
+        "prompt": prompt,
+        "negative_prompt": req.negative_prompt or "",
+        "width": req.width,
+        "height": req.height,
+        "steps": req.steps,
+        "guidance_scale": float(req.guidance_scale),
+        "seed": req.seed,
+        "output_format": req.output_format,
+    }
+    if req.output_format == "png":
+        canonical["compress_level"] = req.compress_level
+    elif req.output_format in ("jpeg", "webp"):
+        canonical["quality"] = req.quality
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+async def result_store_janitor():
+    """后台任务：定期清理过期的生成结果"""
+    while True:
+        await asyncio.sleep(30)
+        result_store.purge_expired()
+        image_store.purge_expired()
+        await asyncio.to_thread(job_runner.purge_expired)
 
 @app.get("/get_images/{session_id}")
 async def get_images(session_id: str):
-    if session_id in temp_data:
-        data = temp_data[session_id]
-        del temp_data[session_id]  # Clean up
+    # TTL 内可重复读取，过期或被淘汰后返回 404
+    data = result_store.get(session_id)
+    if data is not None:
         return {"images": data['images']}
     raise HTTPException(status_code=404, detail="Session not found")
 
 @app.post("/generate")
-def generate_image(req: GenerateRequest):
+def generate_image(req: GenerateRequest, x_profile: Annotated[Optional[str], Header()] = None):
     if req.height % 16 != 0 or req.width % 16 != 0:
         raise HTTPException(status_code=400, detail="Dimensions must be divisible by 16")
+    bucket = resolve_bucket(req)
+    labels = request_labels(req, request_endpoint.get())
+    profile = start_profile(labels["endpoint"], x_profile)
 
     try:
-        pipeline = get_pipeline(req.model_id)
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        
-        prompt = req.prompt
-        if req.enhance_prompt:
-            prompt = f"masterpiece, best quality, highly detailed, {prompt}"
-        
-        images = []
-        for i in range(req.num_images):
-            seed = req.seed if req.seed != -1 else torch.randint(0, 2**32, (1,)).item()
-            generator = torch.Generator(device).manual_seed(seed)
-            
-            # 根据模型类型构建参数
-            model_info = get_model_info(current_model_id)
-            params = {
-                'prompt': prompt,
-                'height': req.height,
-                'width': req.width,
-                'num_inference_steps': req.steps,
-                'guidance_scale': req.guidance_scale,
-                'generator': generator,
-            }
-            
-            # Flux2Pipeline不支持negative_prompt
-            if model_info and model_info.get('type') != 'flux2':
-                params['negative_prompt'] = req.negative_prompt or ""
-            
-            result = pipeline(**params)
+        with track_request(labels, profile):
+            prompt = req.prompt
+            if req.enhance_prompt:
+                prompt = f"masterpiece, best quality, highly detailed, {prompt}"
             
-            # 处理不同Pipeline的返回值
-            if hasattr(result, 'images') and result.images:
-                image = result.images[0]
-            elif isinstance(result, list) and len(result) > 0:
-                image = result[0]
+            seeds = [
+                req.seed if req.seed != -1 else torch.randint(0, 2**32, (1,)).item()
+                for _ in range(req.num_images)
+            ]
+            # 固定 seed 的请求先查确定性结果缓存，命中时不经过调度器和模型
+            cache_key = result_cache_key(req, prompt)
+            cached = result_cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                data, ext = cached
+                images = [image_payload(data, ext, seed, req.legacy_base64, labels) for seed in seeds]
             else:
-                raise Exception("Pipeline returned unexpected format")
+                # 提交到调度器，与其他兼容请求合并推理
+                results = scheduler.submit(req, prompt, seeds).result()
+                
+                encodings = [submit_encode(image, req, labels) for image in results]
+                images = []
+                for encoding, seed in zip(encodings, seeds):
+                    data, ext = encoding.result()
+                    images.append(image_payload(data, ext, seed, req.legacy_base64, labels))
+                if cache_key:
+                    result_cache.put(cache_key, *encodings[0].result())
             
-            buffered = io.BytesIO()
-            image.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            images.append({
-                "image": f"data:image/png;base64,{img_str}",
-                "seed": seed
-            })
-        
-        # Save to history
-        history = load_history()
-        history.append({
-            "timestamp": datetime.now().isoformat(),
-            "prompt": req.prompt,
-            "negative_prompt": req.negative_prompt,
-            "params": {
-                "width": req.width,
-                "height": req.height,
-                "steps": req.steps,
-                "guidance_scale": req.guidance_scale,
-                "seed": req.seed
-            }
-        })
-        save_history(history)
-        
-        return {"images": images}
+            # Save to history
+            record_history(req)
+            
+            return {"images": images, "cache_hit": cached is not None, "bucket": bucket, "profile_id": profile.id if profile else None}
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -555,6 +2809,10 @@ class Img2ImgRequest(BaseModel):
     steps: int = 8
     guidance_scale: float = 7.5
     seed: int = -1
+    legacy_base64: bool = False
+    output_format: Literal["png", "jpeg", "webp", "webp_lossless"] = "png"
+    compress_level: int = 6
+    quality: int = 90
 
 @app.post("/img2img")
 def img2img(req: Img2ImgRequest):
@@ -563,37 +2821,362 @@ def img2img(req: Img2ImgRequest):
         img_data = base64.b64decode(req.image.split(',')[1])
         init_image = Image.open(io.BytesIO(img_data)).convert("RGB")
         
-        pipeline = get_pipeline()
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        
         seed = req.seed if req.seed != -1 else torch.randint(0, 2**32, (1,)).item()
-        generator = torch.Generator(device).manual_seed(seed)
         
-        # Note: Z-Image may not support img2img directly, this is a placeholder
-        result = pipeline(
-            prompt=req.prompt,
-            image=init_image,
-            strength=req.strength,
-            num_inference_steps=req.steps,
-            guidance_scale=req.guidance_scale,
-            generator=generator,
-        ).images[0]
+        worker = scheduler.route()
         
-        buffered = io.BytesIO()
-        result.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        def run():
+            pipeline = get_pipeline(worker.pool)
+            device = worker.device.name
+            generator = torch.Generator(device).manual_seed(seed)
+            
+            # Note: Z-Image may not support img2img directly, this is a placeholder
+            return pipeline(
+                prompt=req.prompt,
+                image=init_image,
+                strength=req.strength,
+                num_inference_steps=req.steps,
+                guidance_scale=req.guidance_scale,
+                generator=generator,
+            ).images[0]
         
-        return {"image": f"data:image/png;base64,{img_str}", "seed": seed}
+        result = worker.call(run)
+        
+        data, ext = submit_encode(result, req).result()
+        return image_payload(data, ext, seed, req.legacy_base64)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ============ Async Jobs ============
+
+class JobRequest(GenerateRequest):
+    webhook_url: Optional[str] = None  # 任务完成或失败后 POST 任务状态到该地址
+
+class JobStore:
+    """基于 SQLite 的持久化任务队列
+
+    任务按提交顺序（自增 seq）执行；启动任务消费者时上次未完成的 running 任务重新排队。
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, status TEXT NOT NULL, "
+            "request TEXT NOT NULL, num_images INTEGER NOT NULL, webhook_url TEXT, webhook_status TEXT, "
+            "created REAL NOT NULL, started REAL, finished REAL, result TEXT, error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, seq)")
+
+    def requeue_interrupted(self):
+        # 不放在 __init__ 中：只在任务执行器启动时恢复，单纯导入本模块（如基准脚本）不改动队列
+        with self._lock:
+            requeued = self._conn.execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'").rowcount
+        if requeued:
+            print(f"Requeued {requeued} interrupted job(s)")
+
+    def _rows(self, sql, args=()):
+        cursor = self._conn.execute(sql, args)
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def add(self, job_id, request, num_images, webhook_url=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, request, num_images, webhook_url, created) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, json.dumps(request, ensure_ascii=False), num_images, webhook_url, time.time()),
+            )
+
+    def get(self, job_id):
+        with self._lock:
+            rows = self._rows("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def list(self, status=None, limit=50):
+        where, args = ("WHERE status = ?", (status,)) if status else ("", ())
+        with self._lock:
+            return self._rows(f"SELECT * FROM jobs {where} ORDER BY seq DESC LIMIT ?", (*args, limit))
+
+    def claim_next(self):
+        """取出最早排队的任务并标记为 running"""
+        with self._lock:
+            rows = self._rows("SELECT * FROM jobs WHERE status = 'queued' ORDER BY seq LIMIT 1")
+            if not rows:
+                return None
+            row = rows[0]
+            row["status"], row["started"] = "running", time.time()
+            self._conn.execute("UPDATE jobs SET status = 'running', started = ? WHERE seq = ?", (row["started"], row["seq"]))
+            return row
+
+    def finish(self, job_id, status, result=None, error=None):
+        """running 任务结束；任务已被取消时返回 False"""
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? WHERE id = ? AND status = 'running'",
+                (status, time.time(), json.dumps(result) if result is not None else None, error, job_id),
+            ).rowcount > 0
+
+    def cancel(self, job_id):
+        """取消排队或运行中的任务，返回取消前的状态（已结束或不存在时返回 None）"""
+        with self._lock:
+            rows = self._rows("SELECT status FROM jobs WHERE id = ?", (job_id,))
+            if not rows or rows[0]["status"] not in ("queued", "running"):
+                return None
+            self._conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?", (time.time(), job_id))
+            return rows[0]["status"]
+
+    def set_webhook_status(self, job_id, status):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET webhook_status = ? WHERE id = ?", (status, job_id))
+
+    def images_ahead(self, seq):
+        """排在该任务前面的排队图片数与正在运行的图片数"""
+        with self._lock:
+            queued = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(num_images), 0) FROM jobs WHERE status = 'queued' AND seq < ?", (seq,)
+            ).fetchone()
+            running = self._conn.execute("SELECT COALESCE(SUM(num_images), 0) FROM jobs WHERE status = 'running'").fetchone()
+        return queued[0], queued[1], running[0]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def purge_finished(self, before):
+        """删除 before 之前结束的任务，返回被删除的任务 ID"""
+        with self._lock:
+            ids = [row[0] for row in self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('completed', 'failed', 'cancelled') AND finished < ?", (before,)
+            ).fetchall()]
+            self._conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in ids])
+        return ids
+
+class JobRunner:
+    """在事件循环上消费任务队列：同时最多 job_concurrency 个任务提交给调度器，结果图片写入 job_dir
+
+    ETA 按最近完成任务的吞吐（图片/秒，按墙钟时间计算，已包含合批与多设备并行）估算。
+    """
+    def __init__(self, store, directory):
+        self.store = store
+        self.dir = directory
+        self.running = {}  # 任务ID -> asyncio.Task
+        self.recent = deque(maxlen=50)  # (开始时间, 完成时间, 图片数)
+        self.wakeup = None
+        self.loop = None
+
+    def throughput(self):
+        """最近完成任务的图片/秒；样本不足时返回 None"""
+        recent = list(self.recent)
+        if not recent:
+            return None
+        span = max(end for _, end, _ in recent) - min(start for start, _, _ in recent)
+        return sum(images for _, _, images in recent) / span if span > 0 else None
+
+    def payload(self, row):
+        request = json.loads(row["request"])
+        request.pop("webhook_url", None)
+        result = {
+            "id": row["id"],
+            "status": row["status"],
+            "created_at": datetime.fromtimestamp(row["created"]).isoformat(),
+            "started_at": datetime.fromtimestamp(row["started"]).isoformat() if row["started"] else None,
+            "finished_at": datetime.fromtimestamp(row["finished"]).isoformat() if row["finished"] else None,
+            "request": request,
+            "images": json.loads(row["result"])["images"] if row["result"] else [],
+            "bucket": json.loads(row["result"]).get("bucket") if row["result"] else None,
+            "error": row["error"],
+        }
+        if row["webhook_url"]:
+            result["webhook"] = {"url": row["webhook_url"], "status": row["webhook_status"]}
+        rate = self.throughput()
+        if row["status"] == "queued":
+            position, queued_images, running_images = self.store.images_ahead(row["seq"])
+            result["position"] = position + 1
+            if rate:
+                result["eta_seconds"] = round((queued_images + running_images + row["num_images"]) / rate, 1)
+        elif row["status"] == "running" and rate:
+            result["eta_seconds"] = round(max(0.0, row["num_images"] / rate - (time.time() - row["started"])), 1)
+        return result
+
+    def submit(self, req):
+        job_id = uuid.uuid4().hex
+        self.store.add(job_id, req.model_dump(), req.num_images, req.webhook_url)
+        if self.wakeup is not None:
+            # 同步端点在线程池中调用，asyncio.Event 只能在事件循环线程上设置
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return job_id
+
+    def cancel(self, job_id):
+        previous = self.store.cancel(job_id)
+        task = self.running.get(job_id)
+        if previous == "running" and task is not None:
+            task.cancel()
+        return previous
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.store.requeue_interrupted()
+        while True:
+            self.wakeup.clear()
+            limit = max(1, int(model_config.get("job_concurrency", 4)))
+            while len(self.running) < limit:
+                row = self.store.claim_next()
+                if row is None:
+                    break
+                task = asyncio.create_task(self.execute(row))
+                self.running[row["id"]] = task
+                task.add_done_callback(lambda t, job_id=row["id"]: (self.running.pop(job_id, None), self.wakeup.set()))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+
+    def save_images(self, job_id, encoded, seeds):
+        job_dir = os.path.join(self.dir, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        images = []
+        for i, ((data, ext), seed) in enumerate(zip(encoded, seeds)):
+            with open(os.path.join(job_dir, f"{i}.{ext}"), "wb") as f:
+                f.write(data)
+            images.append({"url": f"/jobs/{job_id}/images/{i}.{ext}", "seed": seed})
+        return images
+
+    async def execute(self, row):
+        job_id = row["id"]
+        request = json.loads(row["request"])
+        request.pop("webhook_url", None)
+        req = GenerateRequest(**request)
+        # 与同步端点一样对齐到已预热的桶，避免触发重新编译
+        bucket = resolve_bucket(req)
+        request_endpoint.set("jobs")
+        labels = request_labels(req, "jobs")
+        start = time.time()
+        try:
+            with track_request(labels):
+                prompt = req.prompt
+                if req.enhance_prompt:
+                    prompt = f"masterpiece, best quality, highly detailed, {prompt}"
+                seeds = [
+                    req.seed if req.seed != -1 else torch.randint(0, 2**32, (1,)).item()
+                    for _ in range(req.num_images)
+                ]
+                future = scheduler.submit(req, prompt, seeds)
+                try:
+                    results = await asyncio.wrap_future(future)
+                except asyncio.CancelledError:
+                    cancel_generation(future)
+                    raise
+                encoded = await asyncio.gather(*[asyncio.wrap_future(submit_encode(image, req, labels)) for image in results])
+                del results
+                images = await asyncio.to_thread(self.save_images, job_id, encoded, seeds)
+            record_history(req)
+            self.recent.append((start, time.time(), len(seeds)))
+            finished = self.store.finish(job_id, "completed", {"images": images, "bucket": bucket})
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            finished = self.store.finish(job_id, "failed", error=getattr(e, "detail", None) or str(e))
+        if finished:
+            await self.notify(job_id)
+
+    async def notify(self, job_id):
+        """任务结束后调用 webhook，失败时重试 3 次"""
+        row = self.store.get(job_id)
+        url = row["webhook_url"]
+        if not url:
+            return
+        import httpx
+        status = None
+        for attempt in range(3):
+            try:
+                async with httpx.AsyncClient(timeout=10) as client:
+                    response = await client.post(url, json=self.payload(row))
+                status = f"delivered ({response.status_code})" if response.status_code < 400 else f"http {response.status_code}"
+                if response.status_code < 400:
+                    break
+            except Exception as e:
+                status = f"error: {e}"
+            if attempt < 2:
+                await asyncio.sleep(2 ** attempt)
+        self.store.set_webhook_status(job_id, status)
+
+    def purge_expired(self):
+        for job_id in self.store.purge_finished(time.time() - model_config.get("job_ttl", 86400)):
+            shutil.rmtree(os.path.join(self.dir, job_id), ignore_errors=True)
+
+job_store = JobStore(model_config.get("job_db") or "jobs.db")
+job_runner = JobRunner(job_store, model_config.get("job_dir") or "jobs")
+
+@app.post("/jobs", status_code=202)
+def create_job(req: JobRequest):
+    """提交异步生成任务，立即返回任务 ID"""
+    if req.height % 16 != 0 or req.width % 16 != 0:
+        raise HTTPException(status_code=400, detail="Dimensions must be divisible by 16")
+    job_id = job_runner.submit(req)
+    return job_runner.payload(job_store.get(job_id))
+
+@app.get("/jobs")
+def list_jobs(status: Optional[str] = None, limit: int = 50):
+    return {
+        "jobs": [job_runner.payload(row) for row in job_store.list(status, limit)],
+        "counts": job_store.counts(),
+        "throughput_images_per_second": job_runner.throughput(),
+    }
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """任务状态、排队位置、预计剩余时间与结果图片"""
+    row = job_store.get(job_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_runner.payload(row)
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    previous = job_runner.cancel(job_id)
+    if previous is None:
+        if job_store.get(job_id) is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        raise HTTPException(status_code=409, detail="Job already finished")
+    return job_runner.payload(job_store.get(job_id))
+
+@app.get("/jobs/{job_id}/images/{name}")
+def get_job_image(job_id: str, name: str):
+    if os.path.basename(job_id) != job_id or os.path.basename(name) != name:
+        raise HTTPException(status_code=400, detail="Invalid path")
+    path = os.path.join(job_runner.dir, job_id, name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(path, media_type=IMAGE_MEDIA_TYPES.get(name.rpartition(".")[2], "application/octet-stream"))
+
 @app.get("/history")
-def get_history():
-    return load_history()
+def get_history(
+    cursor: Optional[int] = None,
+    limit: int = 50,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    model: Optional[str] = None,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+):
+    """分页获取生成历史（按时间倒序），since/until 为 ISO 时间字符串"""
+    items, next_cursor = history_store.query(
+        cursor=cursor,
+        limit=max(1, min(limit, 500)),
+        since=since,
+        until=until,
+        model_id=model,
+        width=width,
+        height=height,
+    )
+    return {"items": items, "next_cursor": next_cursor}
 
 @app.delete("/history")
 def clear_history():
-    save_history([])
+    history_store.clear()
     return {"status": "success"}
 
 class PresetRequest(BaseModel):
@@ -609,7 +3192,7 @@ def save_preset(req: PresetRequest):
 
 @app.get("/presets")
 def get_presets():
-    return load_presets()
+    return presets_cache.get()
 
 @app.delete("/presets/{name}")
 def delete_preset(name: str):
@@ -631,28 +3214,108 @@ def gpu_info():
         "current_device": torch.cuda.current_device(),
         "memory_allocated": torch.cuda.memory_allocated(0) / 1024**3,
         "memory_reserved": torch.cuda.memory_reserved(0) / 1024**3,
+        "devices": [worker.device.stats() for worker in scheduler.workers],
     }
 
 @app.get("/health")
 def health():
+    active = active_model()
     return {
         "status": "ok", 
-        "model_loaded": pipe is not None,
-        "model_on_gpu": pipe_on_gpu if pipe is not None else False,
+        "model_loaded": any(pool.models for pool in scheduler.pools()),
+        "model_on_gpu": any(entry.on_gpu for pool in scheduler.pools() for entry in pool.models.values()),
         "keep_in_memory": model_config.get("keep_in_memory", False),
-        "current_model": current_model_id
+        "current_model": active.model_id if active else None,
+        "queue_depth": scheduler.queue_depth(),
+        "result_store": result_store.stats(),
+        "image_store": image_store.stats(),
+        "prompt_cache": prompt_cache.stats(),
+        "result_cache": result_cache.stats(),
+        "model_pool": {pool.device.name: pool.stats() for pool in scheduler.pools()},
+        # OOM 后下调的子批次上限（"模型@设备 宽x高" -> 批次大小），为空表示没有限制
+        "batch_size_limits": {
+            f"{model_id}@{device} {width}x{height}": limit
+            for (model_id, device, width, height), limit in list(batch_size_limits.items())
+        },
     }
 
+@app.get("/health/live")
+async def liveness():
+    """存活探针：只要事件循环在响应就返回 200，不触碰模型和推理线程"""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness():
+    """就绪探针：preload_models 中的每个模型都至少在一个设备上就绪时返回 200，否则 503"""
+    states = {}
+    for pool in scheduler.pools():
+        for model_id, info in list(pool.states.items()):
+            states.setdefault(model_id, {})[pool.device.name] = info["state"]
+    pending = [
+        model_id for model_id in model_config.get("preload_models") or []
+        if "ready" not in states.get(model_id, {}).values()
+    ]
+    body = {"ready": not pending, "pending": pending, "models": states}
+    return JSONResponse(body, status_code=200 if not pending else 503)
+
+def device_memory_samples():
+    samples = [({"device": "host", "kind": "rss"}, process_rss_bytes())]
+    for worker in scheduler.workers:
+        if worker.device.is_cuda:
+            index = worker.device.index
+            samples.append(({"device": worker.device.name, "kind": "allocated"}, torch.cuda.memory_allocated(index)))
+            samples.append(({"device": worker.device.name, "kind": "reserved"}, torch.cuda.memory_reserved(index)))
+    return samples
+
+metrics_registry.gauge(
+    "zimage_queue_depth", "Queued generation requests, images and control tasks per device", ("device", "kind"),
+    fn=lambda: [
+        ({"device": worker.device.name, "kind": kind}, value)
+        for worker in scheduler.workers for kind, value in worker.queue_depth().items()
+    ],
+)
+metrics_registry.gauge(
+    "zimage_in_flight_images", "Images in the batch currently running on each device", ("device",),
+    fn=lambda: [({"device": worker.device.name}, worker.in_flight_images) for worker in scheduler.workers],
+)
+metrics_registry.gauge(
+    "zimage_in_flight_requests", "Generation requests being handled per endpoint", ("endpoint",),
+    fn=lambda: [({"endpoint": endpoint}, count) for endpoint, count in list(in_flight_requests.items())],
+)
+metrics_registry.gauge("zimage_memory_bytes", "Host RSS and per-device VRAM in use", ("device", "kind"), fn=device_memory_samples)
+metrics_registry.gauge(
+    "zimage_resident_models", "Models resident on each device by location", ("device", "location"),
+    fn=lambda: [
+        ({"device": pool.device.name, "location": location}, sum(
+            1 for entry in list(pool.models.values()) if ("gpu" if entry.on_gpu else "cpu") == location
+        ))
+        for pool in scheduler.pools() for location in ("gpu", "cpu")
+    ],
+)
+
+metrics_registry.gauge(
+    "zimage_jobs", "Async jobs by status", ("status",),
+    fn=lambda: [({"status": status}, count) for status, count in job_store.counts().items()],
+)
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus 指标"""
+    return Response(content=metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/queue")
+def queue_status():
+    """获取调度队列状态"""
+    return scheduler.stats()
+
 @app.get("/api/models")
 def get_models():
     """获取所有可用模型列表"""
+    models_cfg = models_config_cache.get()
+    active = active_model()
     return {
-        "models": [{
-            "id": "Tongyi-MAI/Z-Image-Turbo",
-            "name": "Z-Image-Turbo",
-            "type": "text2img"
-        }],
-        "current_model": current_model_id or "Tongyi-MAI/Z-Image-Turbo"
+        "models": models_cfg.get("models", []),
+        "current_model": (active.model_id if active else None) or models_cfg.get("current_model", "Tongyi-MAI/Z-Image-Turbo")
     }
 
 @app.post("/api/switch-model")
@@ -676,9 +3339,7 @@ def switch_model(request: dict):
     models_cfg['current_model'] = model_id
     save_models_config(models_cfg)
     
-    # 卸载当前模型（下次generate时会自动加载新模型）
-    if pipe is not None:
-        unload_model()
+    # 不再卸载当前模型：模型池按 LRU 预算管理常驻模型，下次generate时按需加载或换入
     
     return {
         "status": "success",
@@ -686,43 +3347,48 @@ def switch_model(request: dict):
         "model": model_info
     }
 
+def move_pipeline_to_gpu(pool):
+    """将该设备最近使用的模型从CPU移到GPU，返回耗时（秒）；未加载或已在GPU上时返回None"""
+    entry = pool.active
+    if entry is None or entry.on_gpu or not entry.movable:
+        return None
+    
+    print(f"Manually moving model to {pool.device.name}...")
+    return pool.swap_in(entry, wait=True)
+
 @app.post("/api/move-to-gpu")
 def move_to_gpu():
     """手动将模型从CPU移到GPU"""
-    global pipe, pipe_on_gpu
-    if pipe is None:
+    if active_model() is None:
         raise HTTPException(status_code=400, detail="Model not loaded")
-    if pipe_on_gpu:
+    moved = [elapsed for elapsed in scheduler.call_all(move_pipeline_to_gpu) if elapsed is not None]
+    if not moved:
         return {"status": "success", "message": "Model already on GPU"}
-    
-    print("Manually moving model to GPU...")
-    start = time.time()
-    pipe.to("cuda")
-    pipe_on_gpu = True
-    elapsed = time.time() - start
-    return {"status": "success", "message": f"Model moved to GPU in {elapsed:.2f}s"}
+    return {"status": "success", "message": f"Model moved to GPU in {sum(moved):.2f}s"}
 
 @app.post("/api/move-to-cpu")
 def move_to_cpu():
     """手动将模型从GPU移到CPU"""
-    unload_from_gpu()
+    scheduler.call_all(unload_from_gpu)
     return {"status": "success", "message": "Model moved to CPU"}
 
 @app.post("/api/unload")
 def api_unload():
     """完全卸载模型"""
-    unload_model()
+    scheduler.call_all(unload_model)
     return {"status": "success", "message": "Model unloaded"}
 
 @app.post("/api/preload")
 def preload_model():
     """预加载模型到内存"""
     try:
-        get_pipeline()
+        worker = scheduler.route()
+        worker.call(get_pipeline, worker.pool)
         return {
             "status": "success", 
             "message": "Model preloaded",
-            "on_gpu": pipe_on_gpu
+            "device": worker.device.name,
+            "on_gpu": worker.pool.active.on_gpu
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -769,11 +3435,16 @@ async def generate_image_mcp(
             num_images=num_images,
             enhance_prompt=enhance_prompt
         )
-        result = generate_image(req)
+        # generate_image 会阻塞等待推理线程，放到线程池中避免卡住事件循环
+        request_endpoint.set("mcp")
+        result = await asyncio.to_thread(generate_image, req)
         return {
             "status": "success",
             "message": f"Generated {num_images} image(s) successfully",
+            "cache_hit": result["cache_hit"],
+            "bucket": result["bucket"],
             "num_images": len(result["images"]),
+            "images": [{"url": img["url"], "seed": img["seed"]} for img in result["images"]],
             "parameters": {
                 "prompt": prompt,
                 "width": width,
@@ -844,9 +3515,26 @@ def create_prompt_template(subject: str, style: str = "photorealistic") -> str:
 # 启动事件：启动自动监控任务
 @app.on_event("startup")
 async def startup_event():
+    # 在各设备的推理线程上后台预加载并预热模型，不阻塞启动和请求处理
+    for model_id in model_config.get("preload_models") or []:
+        try:
+            worker = scheduler.route(model_id)
+        except HTTPException as e:
+            print(f"Cannot preload {model_id}: {e.detail}")
+            continue
+        future = worker.submit_task(preload_model_on, worker.pool, model_id, model_config.get("preload_warmup", True))
+        scheduler.place(model_id, worker, future)
+        print(f"Preloading {model_id} on {worker.device.name}")
     asyncio.create_task(auto_unload_monitor())
+    asyncio.create_task(result_store_janitor())
+    asyncio.create_task(job_runner.run())
     print("Auto-unload monitor started")
 
+@app.on_event("shutdown")
+def shutdown_event():
+    if encode_pool is not None:
+        encode_pool.shutdown(wait=False, cancel_futures=True)
+
 # Mount MCP server at /mcp
 app.mount("/mcp", mcp.streamable_http_app())
 
@@ -854,7 +3542,3 @@ app.mount("/mcp", mcp.streamable_http_app())
 frontend_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend", "dist")
 if os.path.exists(frontend_dir):
     app.mount("/", StaticFiles(directory=frontend_dir, html=True), name="frontend")
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,190 @@
+"""单请求性能剖析
+
+RequestProfile 记录一次请求各阶段的时间片，结束时在 profile_dir/<id>/ 下写出
+stages.trace.json（Chrome trace，可用 chrome://tracing 或 Perfetto 打开）和 summary.json（各阶段耗时汇总）。
+BatchProfiler 在推理线程上包住一次批量推理：CUDA 设备使用 torch.profiler 导出 Chrome trace，
+CPU 上优先使用 pyinstrument 导出 speedscope，未安装时退回 cProfile（pstats + 文本摘要）。
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    PyinstrumentProfiler = None
+
+# cProfile / sys.monitoring 同一时间只能有一个剖析器，多设备同时命中时后来者只记录阶段时间
+_profiler_lock = threading.Lock()
+
+class RequestProfile:
+    def __init__(self, root, endpoint, reason):
+        self.id = uuid.uuid4().hex[:16]
+        self.root = root
+        self.dir = os.path.join(root, self.id)
+        self.endpoint = endpoint
+        self.reason = reason  # "header" 或 "sampled"
+        self.created = time.time()
+        self.meta = {}
+        self._spans = []  # (阶段, 开始时间, 耗时, 线程名)
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, start, duration):
+        with self._lock:
+            self._spans.append((stage, start, duration, threading.current_thread().name))
+
+    def add_file(self, name, write):
+        """write(path) 把剖析器输出写入该请求目录下的 name"""
+        os.makedirs(self.dir, exist_ok=True)
+        write(os.path.join(self.dir, name))
+
+    def summary(self):
+        with self._lock:
+            spans = list(self._spans)
+        stages = {}
+        for stage, _, duration, _ in spans:
+            entry = stages.setdefault(stage, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += duration
+        for entry in stages.values():
+            entry["seconds"] = round(entry["seconds"], 6)
+        return {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "reason": self.reason,
+            "created": datetime.fromtimestamp(self.created).isoformat(),
+            **self.meta,
+            "stages": stages,
+        }
+
+    def chrome_trace(self):
+        with self._lock:
+            spans = list(self._spans)
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for stage, start, duration, thread in spans:
+            if thread not in threads:
+                threads[thread] = len(threads)
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": threads[thread], "args": {"name": thread}})
+            events.append({
+                "name": stage, "cat": "stage", "ph": "X", "pid": pid, "tid": threads[thread],
+                "ts": int((start - self.created) * 1e6), "dur": int(duration * 1e6),
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def finish(self, status, max_traces=None):
+        self.meta["status"] = status
+        self.meta["elapsed"] = round(time.time() - self.created, 6)
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, "stages.trace.json"), "w") as f:
+            json.dump(self.chrome_trace(), f)
+        summary = self.summary()
+        summary["files"] = sorted(os.listdir(self.dir)) + ["summary.json"]
+        with open(os.path.join(self.dir, "summary.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        if max_traces:
+            prune(self.root, max_traces)
+
+class BatchProfiler:
+    """在推理线程上剖析一次批量推理，输出写入批次中每个被剖析请求的目录"""
+    def __init__(self, profiles, use_cuda):
+        self.profiles = profiles
+        self.use_cuda = use_cuda
+        self.kind = None
+
+    def __enter__(self):
+        if not self.profiles or not _profiler_lock.acquire(blocking=False):
+            if self.profiles:
+                for profile in self.profiles:
+                    profile.meta["profiler"] = "busy"
+            return self
+        try:
+            if self.use_cuda:
+                import torch
+                self._profiler = torch.profiler.profile(
+                    activities=[torch.profiler.ProfilerActivity.CPU, torch.profiler.ProfilerActivity.CUDA]
+                )
+                self._profiler.__enter__()
+                self.kind = "torch"
+            elif PyinstrumentProfiler is not None:
+                self._profiler = PyinstrumentProfiler(async_mode="disabled")
+                self._profiler.start()
+                self.kind = "pyinstrument"
+            else:
+                self._profiler = cProfile.Profile()
+                self._profiler.enable()
+                self.kind = "cprofile"
+        except Exception as e:
+            print(f"Failed to start profiler: {e}")
+            _profiler_lock.release()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.kind is None:
+            return False
+        try:
+            if self.kind == "torch":
+                self._profiler.__exit__(None, None, None)
+                table = self._profiler.key_averages().table(sort_by="cuda_time_total", row_limit=50)
+                self._write("torch.trace.json", self._profiler.export_chrome_trace)
+                self._write("torch_ops.txt", lambda path: _write_text(path, table))
+            elif self.kind == "pyinstrument":
+                self._profiler.stop()
+                speedscope = self._profiler.output(SpeedscopeRenderer())
+                self._write("cpu.speedscope.json", lambda path: _write_text(path, speedscope))
+            else:
+                self._profiler.disable()
+                out = io.StringIO()
+                pstats.Stats(self._profiler, stream=out).sort_stats("cumulative").print_stats(50)
+                self._write("cpu.pstats", self._profiler.dump_stats)
+                self._write("cpu_top.txt", lambda path: _write_text(path, out.getvalue()))
+            for profile in self.profiles:
+                profile.meta["profiler"] = self.kind
+                profile.meta["batch_requests"] = len(self.profiles)
+        except Exception as e:
+            print(f"Failed to write profile: {e}")
+        finally:
+            _profiler_lock.release()
+        return False
+
+    def _write(self, name, write):
+        first = self.profiles[0]
+        first.add_file(name, write)
+        for profile in self.profiles[1:]:
+            profile.add_file(name, lambda path: shutil.copyfile(os.path.join(first.dir, name), path))
+
+def _write_text(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+def list_profiles(root):
+    """按时间倒序返回已完成剖析的 summary"""
+    if not os.path.isdir(root):
+        return []
+    summaries = []
+    for name in os.listdir(root):
+        try:
+            with open(os.path.join(root, name, "summary.json")) as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(summaries, key=lambda s: s.get("created", ""), reverse=True)
+
+def prune(root, keep):
+    """只保留最近 keep 个剖析目录"""
+    try:
+        dirs = [os.path.join(root, name) for name in os.listdir(root)]
+    except OSError:
+        return
+    dirs = sorted((d for d in dirs if os.path.isdir(d)), key=os.path.getmtime, reverse=True)
+    for path in dirs[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
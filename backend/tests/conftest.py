@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main 在导入时按相对路径创建历史库、任务库等文件，切到临时目录避免污染工作区
+os.chdir(tempfile.mkdtemp(prefix="zimage-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
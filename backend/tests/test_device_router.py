@@ -0,0 +1,104 @@
+"""DeviceRouter 路由逻辑（假设备，无需 GPU）"""
+import concurrent.futures
+
+import pytest
+
+import main
+
+
+class FakeDevice:
+    def __init__(self, name, free=0):
+        self.name = name
+        self.is_cuda = name.startswith("cuda")
+        self.index = int(name.split(":")[1]) if self.is_cuda else None
+        self.free = free
+
+    def free_memory(self):
+        return self.free
+
+    def total_memory(self):
+        return 80 * 1024**3
+
+    def stats(self):
+        return {"name": self.name}
+
+
+@pytest.fixture
+def models(monkeypatch):
+    registry = {}
+    monkeypatch.setattr(main, "get_model_info", registry.get)
+    monkeypatch.setitem(main.model_config, "devices", None)
+    return registry
+
+
+def make_router(*devices):
+    return main.DeviceRouter(discover=lambda: list(devices))
+
+
+def test_routes_to_least_loaded_device(models):
+    router = make_router(FakeDevice("cuda:0"), FakeDevice("cuda:1"))
+    router.workers[0].in_flight_images = 4
+    assert router.route("m").device.name == "cuda:1"
+    router.workers[1].in_flight_images = 8
+    assert router.route("m").device.name == "cuda:0"
+
+
+def test_ties_prefer_resident_model_then_free_memory(models):
+    router = make_router(FakeDevice("cuda:0", free=10), FakeDevice("cuda:1", free=20))
+    assert router.route("m").device.name == "cuda:1"
+    router.workers[0].pool.set_state("m", "ready")
+    assert router.route("m").device.name == "cuda:0"
+
+
+def test_model_placement_restricts_devices(models):
+    router = make_router(FakeDevice("cuda:0"), FakeDevice("cuda:1"), FakeDevice("cuda:2"))
+    router.workers[2].in_flight_images = 1
+    models["m"] = {"type": "zimage", "devices": [2]}
+    assert router.route("m").device.name == "cuda:2"
+    models["m"] = {"type": "zimage", "devices": ["cuda:0", 2]}
+    assert router.route("m").device.name == "cuda:0"
+    models["m"] = {"type": "zimage", "devices": [5]}
+    with pytest.raises(main.HTTPException):
+        router.route("m")
+
+
+def test_flux_defaults_to_gpu_1_when_present(models):
+    models["flux"] = {"type": "flux2"}
+    router = make_router(FakeDevice("cuda:0"), FakeDevice("cuda:1"))
+    router.workers[1].in_flight_images = 4
+    assert router.route("flux").device.name == "cuda:1"
+    single = make_router(FakeDevice("cuda:0"))
+    assert single.route("flux").device.name == "cuda:0"
+
+
+def test_global_devices_setting_filters_workers(models, monkeypatch):
+    monkeypatch.setitem(main.model_config, "devices", ["cuda:1"])
+    router = make_router(FakeDevice("cuda:0"), FakeDevice("cuda:1"))
+    assert [worker.device.name for worker in router.workers] == ["cuda:1"]
+
+
+def test_requests_follow_a_device_that_is_loading(models):
+    router = make_router(FakeDevice("cuda:0"), FakeDevice("cuda:1"))
+    router.workers[0].pool.set_state("m", "loading")
+    router.workers[0].in_flight_images = 4
+    assert router.route("m").device.name == "cuda:0"
+    router.workers[1].pool.set_state("m", "ready")
+    assert router.route("m").device.name == "cuda:1"
+
+
+def test_route_leaves_pool_state_to_the_worker(models):
+    router = make_router(FakeDevice("cuda:0"), FakeDevice("cuda:1", free=10))
+    worker = router.route("m")
+    assert worker.device.name == "cuda:1"
+    assert worker.pool.state("m") == "unloaded"
+
+    # 已有请求排到 cuda:1 等待加载：即使它更忙，后续请求也跟过去，不在另一个设备上再加载一份
+    queued = concurrent.futures.Future()
+    router.place("m", worker, queued)
+    worker.in_flight_images = 4
+    assert router.route("m") is worker
+    assert worker.pool.state("m") == "unloaded"
+
+    # 排队的请求被取消后记录失效，按负载重新选择
+    queued.cancel()
+    assert router.route("m").device.name == "cuda:0"
@@ -0,0 +1,145 @@
+"""换入顺序与模型池预算（假设备，无需 GPU）"""
+import pytest
+
+import main
+
+
+class FakeCudaDevice:
+    name = "cuda:0"
+    index = 0
+    is_cuda = True
+
+    def total_memory(self):
+        return 100
+
+    def free_memory(self):
+        return 100
+
+
+class FakeEntry:
+    def __init__(self, model_id, size, on_gpu=True):
+        self.model_id = model_id
+        self.bytes = size
+        self.on_gpu = on_gpu
+        self.movable = True
+        self.pinned = None
+        self.pipe = object()
+        self.buckets = {}
+
+    uses_gpu_budget = main.ResidentModel.uses_gpu_budget
+    uses_host_budget = main.ResidentModel.uses_host_budget
+
+    def move_to(self, device):
+        pass
+
+
+class FakeEvent:
+    def __init__(self):
+        self.done = False
+
+    def query(self):
+        return self.done
+
+    def synchronize(self):
+        self.done = True
+
+    def elapsed_time(self, end):
+        return 250.0
+
+
+class FakePinned:
+    swap_in_seconds = main.PinnedWeights.swap_in_seconds
+
+    def __init__(self):
+        self.end = FakeEvent()
+        self._span = (FakeEvent(), self.end)
+
+
+def test_swap_in_order_puts_text_encoders_first():
+    names = ["vae", "transformer", "scheduler_extra", "text_encoder"]
+    assert main.plan_swap_in(names) == ["text_encoder", "transformer", "vae", "scheduler_extra"]
+    assert main.plan_swap_in(["vae", "text_encoder_2", "text_encoder"]) == ["text_encoder", "text_encoder_2", "vae"]
+
+
+def test_swap_in_order_keeps_unknown_components_stable():
+    assert main.plan_swap_in(["b", "a", "transformer"]) == ["transformer", "b", "a"]
+    assert main.plan_swap_in([]) == []
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = main.ModelPool(FakeCudaDevice())
+    monkeypatch.setattr(main, "host_cpu_bytes", pool.cpu_bytes)
+    monkeypatch.setattr(main.torch.cuda, "empty_cache", lambda: None)
+    monkeypatch.setattr(main.torch.cuda, "synchronize", lambda *args: None)
+    monkeypatch.setitem(main.model_config, "model_pool_gpu_gb", 100 / 1024**3)
+    monkeypatch.setitem(main.model_config, "model_pool_cpu_gb", 100 / 1024**3)
+    monkeypatch.setitem(main.model_config, "model_pool_max_models", 3)
+    return pool
+
+
+def add(pool, *entries):
+    for entry in entries:
+        pool.models[entry.model_id] = entry
+        pool.set_state(entry.model_id, "ready")
+
+
+def test_make_room_demotes_least_recently_used_first(pool):
+    add(pool, FakeEntry("old", 40), FakeEntry("new", 40))
+    pool.make_room(gpu_needed=30)
+    assert not pool.models["old"].on_gpu
+    assert pool.models["new"].on_gpu
+
+
+def test_make_room_evicts_when_host_budget_is_full(pool):
+    add(pool, FakeEntry("cached", 80, on_gpu=False), FakeEntry("old", 40), FakeEntry("new", 40))
+    pool.make_room(gpu_needed=30)
+    assert "old" not in pool.models
+    assert pool.state("old") == "unloaded"
+    assert pool.models["cached"].bytes == 80
+
+
+def test_make_room_never_moves_the_kept_model(pool):
+    add(pool, FakeEntry("keep", 90))
+    pool.make_room(gpu_needed=50, keep="keep")
+    assert pool.models["keep"].on_gpu
+
+
+def test_make_room_enforces_model_count(pool, monkeypatch):
+    monkeypatch.setitem(main.model_config, "model_pool_max_models", 2)
+    add(pool, FakeEntry("a", 1), FakeEntry("b", 1))
+    pool.make_room(new_model=True)
+    assert list(pool.models) == ["b"]
+
+
+def test_pinned_models_on_gpu_count_against_host_budget(pool):
+    pinned = FakeEntry("pinned", 60)
+    pinned.pinned = FakePinned()
+    add(pool, pinned, FakeEntry("plain", 30))
+    assert pool.cpu_bytes() == 60
+    assert pool.gpu_bytes() == 90
+    # 新模型需要 50 字节内存：只有驱逐锁页模型才能释放它的内存副本
+    pool.make_room(cpu_needed=50)
+    assert "pinned" not in pool.models
+    assert "plain" in pool.models
+
+
+def test_demoting_a_pinned_model_needs_no_extra_host_memory(pool):
+    pinned = FakeEntry("pinned", 60)
+    pinned.pinned = FakePinned()
+    add(pool, FakeEntry("cached", 40, on_gpu=False), pinned, FakeEntry("new", 40))
+    pool.make_room(gpu_needed=30, keep="new")
+    assert not pool.models["pinned"].on_gpu
+    assert pool.cpu_bytes() == 100
+
+
+def test_pinned_swap_in_is_timed_when_the_copy_finishes(pool):
+    entry = FakeEntry("m", 10, on_gpu=False)
+    entry.pinned = FakePinned()
+    add(pool, entry)
+    assert pool.swap_in(entry) is None
+    assert pool.model_stats["m"]["last_swap_in_seconds"] is None
+    entry.pinned.end.done = True
+    pool.resolve_swap_ins()
+    assert pool.model_stats["m"]["last_swap_in_seconds"] == 0.25
+    assert pool.swap_in(entry, wait=True) == 0.25
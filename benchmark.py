@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Z-Image-Turbo 服务路径离线基准测试
+
+在进程内启动 FastAPI app，用可配置的假管线（每步 sleep 或占用 CPU，返回指定尺寸的图片）
+替换真实模型，按设定的并发数压测 /generate、/generate/stream、/get_images 和 MCP 工具，
+报告吞吐、p50/p95/p99 延迟与每个响应的字节数，结果保存为 JSON 便于跨提交对比。
+
+用法:
+    python benchmark.py --concurrency 1,4,16 --requests 64 --step-ms 20
+    python benchmark.py --endpoints generate,stream --mode cpu --output results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(REPO_DIR, "backend")
+ENDPOINTS = ("generate", "stream", "get_images", "mcp")
+STUB_MODEL_ID = "benchmark/stub"
+
+class StubPipeline:
+    """假管线：接口与 ZImagePipeline 一致，每个去噪步 sleep 或空转 CPU 固定时长"""
+    step_seconds = 0.02
+    encode_seconds = 0.0
+    mode = "sleep"
+
+    def __init__(self):
+        import torch
+        self._interrupt = False
+        self._execution_device = torch.device("cpu")
+        # 一个很小的组件，让模型池能统计字节数与迁移设备
+        self.components = {"transformer": torch.nn.Linear(16, 16)}
+
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        return cls()
+
+    def to(self, *args, **kwargs):
+        return self
+
+    @classmethod
+    def _spend(cls, seconds):
+        if seconds <= 0:
+            return
+        if cls.mode == "cpu":
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                pass
+        else:
+            time.sleep(seconds)
+
+    def encode_prompt(self, prompt, device=None, do_classifier_free_guidance=True, negative_prompt=None, **kwargs):
+        import torch
+        self._spend(self.encode_seconds)
+        positive = [torch.zeros(8, 16) for _ in prompt]
+        negative = [torch.zeros(8, 16) for _ in prompt] if do_classifier_free_guidance else []
+        return positive, negative
+
+    def __call__(self, prompt=None, height=1024, width=1024, num_inference_steps=8, generator=None,
+                 callback_on_step_end=None, prompt_embeds=None, **kwargs):
+        import torch
+        self._interrupt = False
+        count = len(prompt_embeds) if prompt_embeds is not None else len(prompt)
+        for step in range(num_inference_steps):
+            if self._interrupt:
+                break
+            self._spend(self.step_seconds)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, torch.tensor(1000 - step), {})
+
+        class Output:
+            pass
+        output = Output()
+        output.images = torch.rand(count, 3, height, width)
+        return output
+
+def percentile(values, p):
+    """线性插值百分位"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(samples, duration, images_per_request):
+    ok = [s for s in samples if s["ok"]]
+    latencies = [s["latency"] for s in ok]
+    sizes = [s["bytes"] for s in ok]
+    summary = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "duration": round(duration, 4),
+        "throughput_rps": round(len(ok) / duration, 3) if duration > 0 else None,
+        "throughput_images_per_s": round(len(ok) * images_per_request / duration, 3) if duration > 0 else None,
+        "latency": {
+            "mean": round(sum(latencies) / len(latencies), 4) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+        "bytes_per_response": round(sum(sizes) / len(sizes), 1) if sizes else None,
+    }
+    first_events = [s["first_event"] for s in ok if s.get("first_event") is not None]
+    if first_events:
+        summary["first_event_latency"] = {
+            "p50": percentile(first_events, 50),
+            "p95": percentile(first_events, 95),
+            "p99": percentile(first_events, 99),
+        }
+    errors = [s["error"] for s in samples if not s["ok"]]
+    if errors:
+        summary["first_error"] = errors[0]
+    return summary
+
+def generate_payload(args):
+    return {
+        "prompt": args.prompt,
+        "width": args.width,
+        "height": args.height,
+        "steps": args.steps,
+        "num_images": args.num_images,
+        "seed": -1,
+        "model_id": STUB_MODEL_ID,
+        "output_format": args.output_format,
+        "legacy_base64": args.legacy_base64,
+        "use_cache": False,
+    }
+
+async def fetch_images(client, images):
+    """按返回的 URL 下载图片，返回下载的字节数"""
+    total = 0
+    for image in images:
+        url = image.get("url")
+        if url:
+            response = await client.get(url)
+            response.raise_for_status()
+            total += len(response.content)
+    return total
+
+async def run_generate(client, args, state):
+    response = await client.post("/generate", json=generate_payload(args))
+    response.raise_for_status()
+    size = len(response.content)
+    if args.fetch_images:
+        size += await fetch_images(client, response.json()["images"])
+    return {"bytes": size}
+
+async def run_stream(client, args, state):
+    start = time.perf_counter()
+    first_event = None
+    size = 0
+    session_id = None
+    async with client.stream("POST", "/generate/stream", json=generate_payload(args)) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            size += len(line.encode("utf-8")) + 1
+            if not line.startswith("data: "):
+                continue
+            if first_event is None:
+                first_event = time.perf_counter() - start
+            event = json.loads(line[6:])
+            if event.get("type") == "error":
+                raise RuntimeError(event.get("message"))
+            if event.get("type") == "complete":
+                session_id = event.get("session_id")
+    if session_id is None:
+        raise RuntimeError("stream ended without complete event")
+    return {"bytes": size, "first_event": first_event, "session_id": session_id}
+
+async def run_get_images(client, args, state):
+    sessions = state["sessions"]
+    session_id = sessions[state["next"] % len(sessions)]
+    state["next"] += 1
+    response = await client.get(f"/get_images/{session_id}")
+    response.raise_for_status()
+    size = len(response.content)
+    if args.fetch_images:
+        size += await fetch_images(client, response.json()["images"])
+    return {"bytes": size}
+
+async def run_mcp(client, args, state):
+    state["next"] += 1
+    body = {
+        "jsonrpc": "2.0",
+        "id": state["next"],
+        "method": "tools/call",
+        "params": {
+            "name": "generate_image_mcp",
+            "arguments": {
+                "prompt": args.prompt,
+                "width": args.width,
+                "height": args.height,
+                "steps": args.steps,
+                "num_images": args.num_images,
+            },
+        },
+    }
+    headers = {"Accept": "application/json, text/event-stream"}
+    # streamable_http_app 自身的路由是 /mcp，挂载在 /mcp 下
+    response = await client.post("/mcp/mcp", json=body, headers=headers)
+    response.raise_for_status()
+    result = response.json()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    content = result["result"].get("structuredContent") or {}
+    if result["result"].get("isError") or "error" in content:
+        raise RuntimeError(content.get("error") or result["result"])
+    size = len(response.content)
+    if args.fetch_images:
+        size += await fetch_images(client, content.get("images", []))
+    return {"bytes": size}
+
+RUNNERS = {
+    "generate": run_generate,
+    "stream": run_stream,
+    "get_images": run_get_images,
+    "mcp": run_mcp,
+}
+
+async def run_level(client, endpoint, concurrency, args, state):
+    """以固定并发数发出 args.requests 个请求，返回每个请求的样本"""
+    runner = RUNNERS[endpoint]
+    samples = []
+    remaining = [args.requests]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                result = await runner(client, args, state)
+                sample = {"ok": True, "latency": time.perf_counter() - start, **result}
+            except Exception as e:
+                sample = {"ok": False, "latency": time.perf_counter() - start, "bytes": 0, "error": repr(e)}
+            samples.append(sample)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, time.perf_counter() - start
+
+async def run_benchmark(base_url, args):
+    import httpx
+    for name in ("httpx", "mcp"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    results = []
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        state = {"sessions": [], "next": 0}
+        if "get_images" in args.endpoints:
+            for _ in range(max(1, min(args.requests, 8))):
+                state["sessions"].append((await run_stream(client, args, state))["session_id"])
+        for endpoint in args.endpoints:
+            if args.warmup:
+                await run_level(client, endpoint, 1, argparse.Namespace(**{**vars(args), "requests": args.warmup}), state)
+            for concurrency in args.concurrency:
+                samples, duration = await run_level(client, endpoint, concurrency, args, state)
+                summary = summarize(samples, duration, args.num_images if endpoint != "get_images" else 1)
+                summary.update({"endpoint": endpoint, "concurrency": concurrency})
+                results.append(summary)
+                latency = summary["latency"]
+                fmt = lambda v: f"{v * 1000:8.1f}" if v is not None else "       -"
+                print(f"{endpoint:<11} c={concurrency:<4} {summary['throughput_rps'] or 0:8.2f} req/s  "
+                      f"p50{fmt(latency['p50'])}ms  p95{fmt(latency['p95'])}ms  p99{fmt(latency['p99'])}ms  "
+                      f"{summary['bytes_per_response'] or 0:10.0f} B/resp  errors {summary['errors']}")
+    return results
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(app, mcp, port):
+    """在后台线程中启动 uvicorn；MCP 的会话管理器由挂载的子应用使用，需要在同一事件循环中运行"""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+
+    async def serve():
+        async with mcp.session_manager.run():
+            await server.serve()
+
+    thread = threading.Thread(target=lambda: asyncio.run(serve()), name="benchmark-server", daemon=True)
+    thread.start()
+    deadline = time.time() + 60
+    while not server.started:
+        if not thread.is_alive() or time.time() > deadline:
+            raise RuntimeError("benchmark server failed to start")
+        time.sleep(0.05)
+    return server, thread
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the HTTP serving path with a stub pipeline")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"comma separated subset of {','.join(ENDPOINTS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="requests per endpoint and concurrency level")
+    parser.add_argument("--warmup", type=int, default=2, help="warmup requests per endpoint (not recorded)")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--num-images", type=int, default=1)
+    parser.add_argument("--prompt", default="benchmark prompt")
+    parser.add_argument("--output-format", default="png", choices=["png", "jpeg", "webp", "webp_lossless"])
+    parser.add_argument("--legacy-base64", action="store_true", help="embed images as base64 in JSON responses")
+    parser.add_argument("--fetch-images", action="store_true", help="also download returned image URLs")
+    parser.add_argument("--mode", default="sleep", choices=["sleep", "cpu"], help="how the stub spends each step")
+    parser.add_argument("--step-ms", type=float, default=20.0, help="stub time per denoising step")
+    parser.add_argument("--encode-ms", type=float, default=0.0, help="stub time per prompt encode")
+    parser.add_argument("--config", default=None, help="JSON object merged into model_config (e.g. batching settings)")
+    parser.add_argument("--output", default=None, help="result JSON path (default benchmark_results/<commit>_<time>.json)")
+    args = parser.parse_args()
+    args.endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = [e for e in args.endpoints if e not in ENDPOINTS]
+    if unknown:
+        parser.error(f"unknown endpoints: {unknown}")
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    return args
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    commit = git_commit()
+
+    # 后端使用相对路径保存配置、历史和缓存，切换到临时目录避免改动真实数据
+    workdir = tempfile.mkdtemp(prefix="zimage-bench-")
+    rundir = os.path.join(workdir, "backend")
+    os.makedirs(rundir)
+    os.chdir(rundir)
+    with open("models_config.json", "w") as f:
+        json.dump({"models": [{"id": STUB_MODEL_ID, "name": "Benchmark Stub", "type": "zimage"}],
+                   "current_model": STUB_MODEL_ID}, f)
+    sys.path.insert(0, BACKEND_DIR)
+
+    import main as backend
+    StubPipeline.mode = args.mode
+    StubPipeline.step_seconds = args.step_ms / 1000
+    StubPipeline.encode_seconds = args.encode_ms / 1000
+    backend.ZImagePipeline = StubPipeline
+    backend.model_config.update({
+        "model_id": STUB_MODEL_ID,
+        "devices": ["cpu"],
+        "compile_model": False,
+        "preload_models": [],
+        "prepared_snapshots": False,
+    })
+    if args.config:
+        backend.model_config.update(json.loads(args.config))
+
+    port = free_port()
+    server, thread = start_server(backend.app, backend.mcp, port)
+    print(f"🚀 Benchmark server on 127.0.0.1:{port} (stub {args.mode}, {args.step_ms}ms/step, {args.steps} steps, "
+          f"{args.width}x{args.height} x{args.num_images})")
+    try:
+        results = asyncio.run(run_benchmark(f"http://127.0.0.1:{port}", args))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k != "output"},
+        "model_config": {k: backend.model_config.get(k) for k in (
+            "batch_generation", "max_batch_size", "batch_max_wait_ms", "encode_workers", "prompt_cache", "result_cache")},
+        "results": results,
+    }
+    if output is None:
+        os.makedirs(os.path.join(REPO_DIR, "benchmark_results"), exist_ok=True)
+        output = os.path.join(REPO_DIR, "benchmark_results", f"{commit or 'nocommit'}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Results saved to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -134,11 +134,11 @@ def test_prompt_enhancement():
 def test_history():
     print_section("8. 生成历史")
     response = requests.get(f"{API_URL}/history")
-    history = response.json()
+    history = response.json()["items"]  # 按时间倒序的第一页
     print(f"📚 历史记录数: {len(history)}")
     if history:
         print("\n最近3条:")
-        for i, item in enumerate(history[-3:], 1):
+        for i, item in enumerate(history[:3], 1):
             print(f"\n  {i}. {item['timestamp']}")
             print(f"     提示词: {item['prompt'][:50]}...")
             print(f"     尺寸: {item['params']['width']}x{item['params']['height']}")
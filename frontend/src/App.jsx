@@ -140,9 +140,9 @@ function App() {
 
   const fetchHistory = async () => {
     try {
-      const res = await fetch('/history')
+      const res = await fetch('/history?limit=10')
       const data = await res.json()
-      setHistory(data.slice(-10).reverse())
+      setHistory(data.items)
     } catch (e) { console.error(e) }
   }
 
@@ -159,7 +159,9 @@ function App() {
         body: JSON.stringify({ 
           prompt, 
           negative_prompt: negativePrompt || null, 
-          ...settings 
+          ...settings,
+          stream_images: true,
+          preview_every: 2
         })
       })
       
@@ -184,11 +186,16 @@ function App() {
                 setLogs(prev => [...prev, { time: new Date().toLocaleTimeString(), message: data.message }])
               } else if (data.type === 'progress') {
                 // Just log progress, no UI update needed
+              } else if (data.type === 'preview' || data.type === 'image') {
+                // Low-quality latent previews are replaced by each final image as soon as it is encoded
+                setImages(prev => [...prev.filter(img => img.index !== data.index), data].sort((a, b) => a.index - b.index))
               } else if (data.type === 'complete') {
-                // Fetch images separately
-                const imgRes = await fetch(`/get_images/${data.session_id}`)
-                const imgData = await imgRes.json()
-                setImages(imgData.images)
+                // Older servers only send a session_id; fetch the images separately
+                if (data.session_id) {
+                  const imgRes = await fetch(`/get_images/${data.session_id}`)
+                  const imgData = await imgRes.json()
+                  setImages(imgData.images)
+                }
                 fetchHistory()
                 setLoading(false)
               } else if (data.type === 'error') {
@@ -595,7 +602,7 @@ function App() {
               <div className={`image-grid ${getGridCols(images.length)}`} style={{ width: '100%', maxWidth: '1400px', margin: '0 auto' }}>
               {images.map((img, i) => (
                 <div key={i} onClick={() => setSelectedImageIndex(i)} className="hover-scale" style={{ position: 'relative', borderRadius: '12px', border: '1px solid rgba(255,255,255,0.2)', boxShadow: '0 8px 32px rgba(0,0,0,0.3)', cursor: 'pointer', display: 'flex', alignItems: 'center', justifyContent: 'center', minHeight: '200px', background: 'rgba(0,0,0,0.2)' }}>
-                  <img src={img.image} alt="" style={{ maxWidth: '100%', maxHeight: '400px', objectFit: 'contain', display: 'block', borderRadius: '12px' }} />
+                  <img src={img.image} alt="" style={{ maxWidth: '100%', maxHeight: '400px', objectFit: 'contain', display: 'block', borderRadius: '12px', ...(img.type === 'preview' ? { width: '100%', opacity: 0.7 } : {}) }} />
                   <div style={{ position: 'absolute', top: '12px', right: '12px' }}>
                     <button onClick={(e) => { e.stopPropagation(); const a = document.createElement('a'); a.href = img.image; a.download = `z-image-${img.seed}.png`; a.click() }} style={{ padding: '10px', background: 'rgba(0,0,0,0.8)', border: '1px solid rgba(255,255,255,0.3)', borderRadius: '8px', color: '#fff', cursor: 'pointer', backdropFilter: 'blur(10px)' }}>
                       <Download size={18} />
@@ -37,9 +37,21 @@ echo ""
 
 # 生成历史统计
 echo "📈 生成统计:"
-HISTORY=$(curl -s http://localhost:8888/history)
-if [ $? -eq 0 ]; then
-    COUNT=$(echo "$HISTORY" | python3 -c "import sys, json; print(len(json.load(sys.stdin)))" 2>/dev/null)
+# /history 按游标分页，逐页累加
+COUNT=$(python3 - <<'PY' 2>/dev/null
+import json, urllib.request
+url = "http://localhost:8888/history?limit=500"
+count, cursor = 0, None
+while True:
+    page = json.load(urllib.request.urlopen(url + (f"&cursor={cursor}" if cursor is not None else "")))
+    count += len(page["items"])
+    cursor = page["next_cursor"]
+    if cursor is None:
+        break
+print(count)
+PY
+)
+if [ -n "$COUNT" ]; then
     echo "  总生成次数: $COUNT"
 else
     echo "  ❌ 无法获取历史"
@@ -3,10 +3,14 @@
 echo "🚀 Z-Image-Turbo Docker Launcher"
 echo "================================"
 
-# 检测最空闲的GPU
-echo "🔍 Detecting best GPU..."
-GPU_ID=$(python3 select_gpu.py)
-echo "✅ Selected GPU: $GPU_ID"
+# 默认把所有GPU交给容器，后端按负载在各GPU间路由请求；
+# GPU_ID 可指定部分GPU（如 GPU_ID=1,2），PICK_GPU=1 时只使用最空闲的一块
+if [ -z "$GPU_ID" ] && [ "$PICK_GPU" = "1" ]; then
+    echo "🔍 Detecting best GPU..."
+    GPU_ID=$(python3 select_gpu.py)
+fi
+GPU_ID=${GPU_ID:-all}
+echo "✅ GPUs: $GPU_ID"
 
 # 导出GPU ID
 export GPU_ID=$GPU_ID
@@ -15,7 +19,7 @@ export GPU_ID=$GPU_ID
 echo "🏗️  Building Docker image..."
 docker-compose build
 
-echo "🚀 Starting container on GPU $GPU_ID..."
+echo "🚀 Starting container on GPUs $GPU_ID..."
 docker-compose up -d
 
 echo ""
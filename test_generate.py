@@ -32,9 +32,12 @@ def test_generate():
         print(f"\n✅ Success! Generated {len(result['images'])} image(s)")
         
         for i, img_data in enumerate(result['images']):
-            # Save image
-            img_base64 = img_data['image'].split(',')[1]
-            img_bytes = base64.b64decode(img_base64)
+            # Save image (URL by default, base64 when legacy_base64 is set)
+            if 'url' in img_data:
+                img_bytes = requests.get(f"{API_URL}{img_data['url']}").content
+            else:
+                img_base64 = img_data['image'].split(',')[1]
+                img_bytes = base64.b64decode(img_base64)
             
             filename = f"test_output_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{i}.png"
             with open(filename, 'wb') as f: